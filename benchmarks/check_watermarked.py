@@ -0,0 +1,114 @@
+"""Check that the documents written by `write_watermarked` are valid.
+
+PyPDF2 reads documents leniently, so broken output (e.g. a content stream
+written as a direct object, which viewers like MuPDF reject) would go
+unnoticed when reading it back with PyPDF2 alone.  Documents with single,
+compressed and split content streams are watermarked with every engine,
+with and without reusing pages, and the output is checked strictly: every
+cross-reference entry must point to its object, every content stream must
+be an indirect object and the content of every page must be readable.
+
+    python benchmarks/check_watermarked.py --pages 1 10
+"""
+
+import argparse
+import sys
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, IndirectObject, NameObject
+from PyPDF2.pdf import ContentStream
+
+from openreferee_server.watermark import (
+    WATERMARK_ENGINES,
+    WatermarkedPages,
+    watermark_template,
+    write_watermarked,
+)
+
+
+def _make_stream(writer, data, compress):
+    contents = DecodedStreamObject()
+    contents.setData(data)
+    return writer._addObject(contents.flateEncode() if compress else contents)
+
+
+def make_pdf(pages, layout, lines=10):
+    writer = PdfFileWriter()
+    for i in range(pages):
+        page = writer.addBlankPage(595, 842)
+        data = [
+            b"BT /F1 10 Tf 50 %d Td (Page %d, line %d) Tj ET\n" % (800 - j * 18, i, j)
+            for j in range(lines)
+        ]
+        if layout == "split":
+            page[NameObject("/Contents")] = ArrayObject(
+                _make_stream(writer, line, False) for line in data
+            )
+        else:
+            page[NameObject("/Contents")] = _make_stream(
+                writer, b"".join(data), layout == "compressed"
+            )
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def check_pdf(data, pages):
+    """Read a document strictly, raising `AssertionError` if it is invalid."""
+    reader = PdfFileReader(BytesIO(data), strict=True)
+    assert reader.numPages == pages, reader.numPages
+    for idnum, offset in reader.xref[0].items():
+        assert data.startswith(b"%d 0 obj" % idnum, offset), (idnum, offset)
+    for i in range(pages):
+        page = reader.getPage(i)
+        contents = page.raw_get("/Contents")
+        refs = contents.getObject() if isinstance(contents, IndirectObject) else None
+        if isinstance(refs, ArrayObject):
+            contents = refs
+        for ref in contents if isinstance(contents, ArrayObject) else [contents]:
+            assert isinstance(ref, IndirectObject), (i, type(ref).__name__)
+        assert ContentStream(page.getContents(), reader).operations, i
+
+
+def watermark(data, engine, page_cache=None):
+    buf = BytesIO()
+    write_watermarked(PdfFileReader(BytesIO(data)), buf, page_cache, engine)
+    return buf.getvalue()
+
+
+def run(data, pages):
+    """Watermark a document in every way, yielding the name of each run."""
+    for engine in WATERMARK_ENGINES:
+        check_pdf(watermark(data, engine), pages)
+        yield engine
+    page_cache = WatermarkedPages(watermark_template.version)
+    check_pdf(watermark(data, "merge", page_cache), pages)
+    yield "merge, new pages"
+    # all the pages are known now, so none of them is merged again
+    page_cache = WatermarkedPages(page_cache.version, page_cache.added)
+    check_pdf(watermark(data, "merge", page_cache), pages)
+    assert page_cache.num_reused == pages, page_cache.num_reused
+    yield "merge, reused pages"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10])
+    args = parser.parse_args()
+
+    failed = False
+    for pages in args.pages:
+        for layout in ("plain", "compressed", "split"):
+            runs = run(make_pdf(pages, layout), pages)
+            try:
+                for name in runs:
+                    print("{:>6} {:>10}  {}: ok".format(pages, layout, name))
+            except AssertionError as exc:
+                failed = True
+                print("{:>6} {:>10}  FAIL {!r}".format(pages, layout, exc))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""A local stand-in for the Indico endpoints used by the server.
+
+It implements just enough of the tag, file type, editable type, revision and
+file upload endpoints for the server to provision events and process
+revisions against it.  State is kept in memory.
+"""
+
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+from uuid import uuid4
+
+
+EDITABLES = ("paper", "poster")
+
+
+class FakeIndico:
+    """Serve the fake Indico endpoints in a background thread.
+
+    :param latency: seconds to wait before answering any request, to
+                    simulate a remote server
+    :param bandwidth: bytes per second request bodies are read with, to
+                      simulate a slow network (unlimited if not set)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.tags = {}
+        self.file_types = {}
+        self.files = {}
+        self.uploads = {}
+        self.replaced = []
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self.base_url = "http://{}:{}".format(*self.server.server_address)
+
+    def start(self):
+        threading.Thread(
+            target=self.server.serve_forever, name="fake-indico", daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def event_endpoints(self, event):
+        base = "{}/event/{}".format(self.base_url, event)
+        return {
+            "tags": {"create": base + "/tags", "list": base + "/tags"},
+            "editable_types": base + "/editable-types",
+            "file_types": {
+                editable: {
+                    "create": "{}/file-types/{}".format(base, editable),
+                    "list": "{}/file-types/{}".format(base, editable),
+                }
+                for editable in EDITABLES
+            },
+        }
+
+    def editable_endpoints(self, event, contrib_id, editable_type="paper"):
+        base = "{}/event/{}/contributions/{}/editing/{}".format(
+            self.base_url, event, contrib_id, editable_type
+        )
+        return {
+            "revisions": {
+                "details": base + "/revisions/1",
+                "replace": base + "/revisions/1/replace",
+            },
+            "file_upload": base + "/upload",
+        }
+
+    def add_file(self, filename, data):
+        """Make a file available for download and return its URL."""
+        key = uuid4().hex
+        self.files[key] = data
+        return "{}/files/{}/{}".format(self.base_url, key, filename)
+
+    def file_type_id(self, event, editable, name):
+        return self.file_types[event][editable][name]["id"]
+
+
+def _make_handler(indico):
+    routes = []
+
+    def route(method, pattern):
+        def decorator(fn):
+            routes.append((method, re.compile(pattern + "$"), fn))
+            return fn
+
+        return decorator
+
+    @route("GET", r"/event/(\w+)/tags")
+    def list_tags(handler, event):
+        return 200, list(indico.tags.get(event, {}).values())
+
+    @route("POST", r"/event/(\w+)/tags")
+    def create_tag(handler, event):
+        data = handler.read_json()
+        tag_id = next(indico.ids)
+        tag = dict(
+            data,
+            id=tag_id,
+            verbose_title=data["title"],
+            is_used_in_revision=False,
+            url="{}/event/{}/tags/{}".format(indico.base_url, event, tag_id),
+        )
+        with indico.lock:
+            indico.tags.setdefault(event, {})[tag_id] = tag
+        return 201, tag
+
+    @route("DELETE", r"/event/(\w+)/tags/(\d+)")
+    def delete_tag(handler, event, tag_id):
+        with indico.lock:
+            indico.tags.get(event, {}).pop(int(tag_id), None)
+        return 204, None
+
+    @route("POST", r"/event/(\w+)/editable-types")
+    def set_editable_types(handler, event):
+        handler.read_json()
+        return 200, None
+
+    @route("GET", r"/event/(\w+)/file-types/(\w+)")
+    def list_file_types(handler, event, editable):
+        return 200, list(indico.file_types.get(event, {}).get(editable, {}).values())
+
+    @route("POST", r"/event/(\w+)/file-types/(\w+)")
+    def create_file_type(handler, event, editable):
+        data = handler.read_json()
+        file_type = dict(
+            data,
+            id=next(indico.ids),
+            is_used=False,
+            is_used_in_condition=False,
+            url="{}/event/{}/file-types/{}/{}".format(
+                indico.base_url, event, editable, data["name"]
+            ),
+        )
+        with indico.lock:
+            types = indico.file_types.setdefault(event, {}).setdefault(editable, {})
+            types[data["name"]] = file_type
+        return 201, file_type
+
+    @route("DELETE", r"/event/(\w+)/file-types/(\w+)/([^/]+)")
+    def delete_file_type(handler, event, editable, name):
+        with indico.lock:
+            types = indico.file_types.get(event, {}).get(editable, {})
+            types.pop(unquote(name), None)
+        return 204, None
+
+    @route("GET", r"/event/\w+/contributions/\w+/editing/\w+/revisions/\d+")
+    def revision_details(handler):
+        return 200, {}
+
+    @route("POST", r"/event/\w+/contributions/\w+/editing/\w+/revisions/\d+/replace")
+    def replace_revision(handler):
+        data = handler.read_json()
+        with indico.lock:
+            indico.replaced.append(data)
+        return 200, None
+
+    @route("POST", r"/event/\w+/contributions/\w+/editing/\w+/upload")
+    def upload_file(handler):
+        size = 0
+        for chunk in handler.iter_body():
+            size += len(chunk)
+        uuid = str(uuid4())
+        with indico.lock:
+            indico.uploads[uuid] = size
+        return 201, {"uuid": uuid}
+
+    @route("GET", r"/files/(\w+)/[^/]+")
+    def download_file(handler, key):
+        return 200, indico.files[key]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # send the headers and body together, avoiding delayed ACK stalls
+        wbufsize = 65536
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_json(self):
+            return json.loads(b"".join(self.iter_body()) or b"null")
+
+        def iter_body(self):
+            for chunk in self._iter_raw_body():
+                if indico.bandwidth:
+                    time.sleep(len(chunk) / indico.bandwidth)
+                yield chunk
+
+        def _iter_raw_body(self):
+            while self._chunked:
+                line = self.rfile.readline()
+                if not line:
+                    # the client gave up on the request
+                    break
+                size = int(line.split(b";")[0], 16)
+                if not size:
+                    # skip the (empty) trailer
+                    while self.rfile.readline().strip():
+                        pass
+                    self._chunked = False
+                    break
+                chunk = self.rfile.read(size)
+                self.rfile.readline()
+                yield chunk
+            while self._remaining:
+                chunk = self.rfile.read(min(self._remaining, 65536))
+                if not chunk:
+                    break
+                self._remaining -= len(chunk)
+                yield chunk
+
+        def _dispatch(self):
+            self._remaining = int(self.headers.get("Content-Length") or 0)
+            self._chunked = self.headers.get("Transfer-Encoding") == "chunked"
+            if indico.latency:
+                time.sleep(indico.latency)
+            path = self.path.partition("?")[0]
+            for method, pattern, fn in routes:
+                match = pattern.match(path)
+                if method == self.command and match:
+                    status, data = fn(self, *match.groups())
+                    break
+            else:
+                status, data = 404, {"error": "Not found"}
+            if isinstance(data, bytes):
+                body, content_type = data, "application/pdf"
+            elif data is not None:
+                body, content_type = json.dumps(data).encode(), "application/json"
+            else:
+                body, content_type = b"", None
+            # drain any unread body so the connection can be reused
+            for __ in self.iter_body():
+                pass
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_DELETE = _dispatch
+
+    return Handler
@@ -0,0 +1,360 @@
+"""Load test the server against a local stand-in for Indico.
+
+Boots the application with `create_app`, serves it on a local port and
+drives it over HTTP like Indico would: events are registered, revisions
+are reviewed in bursts and new editables with PDFs of varying page counts
+are submitted, after which the job worker watermarks the queued files.
+Throughput, p50/p99 latency and the peak RSS of the process (which also
+runs the fake Indico) are reported for each phase.
+
+    python benchmarks/load.py --events 5 --reviews 1000 --concurrency 8
+    python benchmarks/load.py --db postgresql:///openreferee_bench --json > base.json
+    python benchmarks/load.py --compare base.json
+
+When comparing, the exit code is 1 if the throughput of a phase dropped or
+its p99 latency grew by more than ``--tolerance``.  Events created in a
+PostgreSQL database are removed again, but the tables are left in place.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from uuid import uuid4
+
+import requests
+from PyPDF2 import PdfFileWriter
+from werkzeug.serving import make_server
+
+from fake_indico import FakeIndico
+from openreferee_server.app import create_app
+from openreferee_server.db import db
+from openreferee_server.jobs import JOB_HANDLERS, run_worker
+
+
+USER = {"id": 1, "full_name": "Guinea Pig", "identifier": "User:1"}
+
+
+def make_pdf(pages):
+    writer = PdfFileWriter()
+    for __ in range(pages):
+        writer.addBlankPage(595, 842)
+    # make every document unique so it is not served from the watermark cache
+    writer.addMetadata({"/Title": uuid4().hex})
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(name, latencies, errors, elapsed, **extra):
+    return dict(
+        name=name,
+        requests=len(latencies),
+        errors=errors,
+        throughput=len(latencies) / elapsed if elapsed else 0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        peak_rss_mb=peak_rss_mb(),
+        **extra,
+    )
+
+
+def run_phase(name, base_url, calls, concurrency):
+    """Send requests concurrently and measure their latency.
+
+    :param calls: ``(method, path, token, payload, expected_status)`` tuples
+    """
+    local = threading.local()
+    latencies = []
+    errors = []
+
+    def _send(call):
+        method, path, token, payload, expected_status = call
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        headers = {"Authorization": "Bearer " + token} if token else {}
+        start = time.perf_counter()
+        resp = session.request(method, base_url + path, json=payload, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        if resp.status_code != expected_status:
+            errors.append("{} {}: {}".format(method, path, resp.status_code))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(_send, calls))
+    elapsed = time.perf_counter() - start
+    for error in errors[:5]:
+        logging.warning("%s: unexpected response to %s", name, error)
+    return summarize(name, latencies, len(errors), elapsed)
+
+
+def run_worker_phase(app, concurrency, pages):
+    latencies = []
+    handler = JOB_HANDLERS["watermark"]
+
+    def _timed_handler(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    JOB_HANDLERS["watermark"] = _timed_handler
+    try:
+        start = time.perf_counter()
+        run_worker(app, concurrency, poll_interval=0.05, burst=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        JOB_HANDLERS["watermark"] = handler
+    return summarize(
+        "watermark-jobs",
+        latencies,
+        0,
+        elapsed,
+        pages_per_second=pages / elapsed if elapsed else 0,
+    )
+
+
+def make_revision(files, final_state="ready_for_review", comment=""):
+    return {
+        "comment": comment,
+        "submitter": USER,
+        "editor": None,
+        "initial_state": {"name": "ready_for_review"},
+        "final_state": {"name": final_state},
+        "tags": [],
+        "files": files,
+    }
+
+
+def run(args):
+    indico = FakeIndico(latency=args.indico_latency / 1000).start()
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_port)
+
+    run_id = uuid4().hex[:8]
+    events = {"bench{}{}".format(run_id, i): uuid4().hex for i in range(args.events)}
+    results = []
+
+    results.append(
+        run_phase(
+            "register-events",
+            base_url,
+            [
+                (
+                    "PUT",
+                    "/event/" + event,
+                    None,
+                    {
+                        "title": "Benchmark event",
+                        "url": indico.base_url,
+                        "token": token,
+                        "endpoints": indico.event_endpoints(event),
+                    },
+                    201,
+                )
+                for event, token in events.items()
+            ],
+            args.concurrency,
+        )
+    )
+
+    review_calls = []
+    event_cycle = itertools.cycle(events.items())
+    for i in range(args.reviews):
+        event, token = next(event_cycle)
+        if i % 3 == 0:
+            revision = make_revision([], "accepted", "publish" if i % 2 else "")
+        else:
+            revision = make_revision([], "needs_submitter_changes")
+        review_calls.append(
+            (
+                "POST",
+                "/event/{}/editable/paper/{}/{}".format(event, i, i),
+                token,
+                {
+                    "action": "update",
+                    "revision": revision,
+                    "endpoints": indico.editable_endpoints(event, i),
+                },
+                201,
+            )
+        )
+    results.append(
+        run_phase("review-editable", base_url, review_calls, args.concurrency)
+    )
+
+    editable_calls = []
+    total_pages = 0
+    page_counts = itertools.cycle(args.pages)
+    for i in range(args.editables):
+        event, token = next(event_cycle)
+        pages = next(page_counts)
+        total_pages += pages
+        filename = "paper{}.pdf".format(i)
+        file = {
+            "uuid": str(uuid4()),
+            "filename": filename,
+            "content_type": "application/pdf",
+            "file_type": indico.file_type_id(event, "paper", "PDF"),
+            "signed_download_url": indico.add_file(filename, make_pdf(pages)),
+        }
+        editable_calls.append(
+            (
+                "PUT",
+                "/event/{}/editable/paper/{}".format(event, i),
+                token,
+                {
+                    "editable": {"id": i, "type": "paper", "state": "ready_for_review"},
+                    "revision": make_revision([file]),
+                    "endpoints": indico.editable_endpoints(event, i),
+                },
+                201,
+            )
+        )
+    results.append(
+        run_phase("create-editable", base_url, editable_calls, args.concurrency)
+    )
+    results.append(run_worker_phase(app, args.worker_concurrency, total_pages))
+    if len(indico.replaced) != args.editables:
+        logging.warning(
+            "Only %d of %d revisions were replaced",
+            len(indico.replaced),
+            args.editables,
+        )
+
+    results.append(
+        run_phase(
+            "remove-events",
+            base_url,
+            [
+                ("DELETE", "/event/" + event, token, None, 204)
+                for event, token in events.items()
+            ],
+            args.concurrency,
+        )
+    )
+    server.shutdown()
+    indico.stop()
+    return results
+
+
+def print_results(results):
+    print(
+        "{:<16} {:>8} {:>6} {:>10} {:>9} {:>9} {:>9}".format(
+            "phase", "requests", "errors", "req/s", "p50 ms", "p99 ms", "RSS MB"
+        )
+    )
+    for r in results:
+        print(
+            "{name:<16} {requests:>8} {errors:>6} {throughput:>10.1f} "
+            "{p50_ms:>9.2f} {p99_ms:>9.2f} {peak_rss_mb:>9.1f}".format(**r)
+        )
+        if "pages_per_second" in r:
+            print("{:<16} {:.1f} pages/s".format("", r["pages_per_second"]))
+
+
+def compare(results, baseline, tolerance):
+    baseline = {r["name"]: r for r in baseline}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["name"])
+        if base is None:
+            continue
+        if r["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                "{}: throughput {:.1f} < {:.1f} req/s".format(
+                    r["name"], r["throughput"], base["throughput"]
+                )
+            )
+        if r["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                "{}: p99 {:.2f} > {:.2f} ms".format(
+                    r["name"], r["p99_ms"], base["p99_ms"]
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n")[0])
+    parser.add_argument(
+        "--db", help="Database URI (defaults to a temporary SQLite database)"
+    )
+    parser.add_argument("--events", type=int, default=5)
+    parser.add_argument("--reviews", type=int, default=500)
+    parser.add_argument("--editables", type=int, default=20)
+    parser.add_argument(
+        "--pages",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1, 10, 50],
+        help="Comma-separated page counts of the submitted PDFs",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--worker-concurrency",
+        type=int,
+        default=4,
+        help="Number of worker threads",
+    )
+    parser.add_argument(
+        "--indico-latency",
+        type=float,
+        default=0,
+        help="Milliseconds the fake Indico waits before answering",
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON results")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s %(message)s")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["WATERMARK_CACHE_PATH"] = os.path.join(tmpdir, "watermarks.db")
+        if not args.db:
+            args.db = "sqlite:///" + os.path.join(tmpdir, "openreferee.db")
+        os.environ["SQLALCHEMY_DATABASE_URI"] = args.db
+        results = run(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Compare watermarking revisions of a document with and without page reuse.
+
+Each revision of the document changes a few pages of the previous one,
+like a submitter fixing typos.  With page reuse, the watermarked content
+of the pages of all previous revisions is loaded from the watermark cache
+and only the changed pages are merged with the watermark.  The time to
+watermark and write every revision is reported, including the cache
+lookups, and the watermarked pages are checked against `mergePage`.
+
+    python benchmarks/page_reuse.py --pages 50 300 --revisions 5 --changed 3
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+
+from openreferee_server.dedup import WatermarkCache
+from openreferee_server.watermark import (
+    WatermarkedPages,
+    merge_watermark,
+    watermark_template,
+)
+
+
+def make_pdf(texts, lines=40):
+    writer = PdfFileWriter()
+    for text in texts:
+        page = writer.addBlankPage(595, 842)
+        contents = DecodedStreamObject()
+        contents.setData(
+            b"".join(
+                b"BT /F1 10 Tf 50 %d Td (%s, line %d) Tj ET\n"
+                % (800 - i * 18, text.encode(), i)
+                for i in range(lines)
+            )
+        )
+        page[NameObject("/Contents")] = writer._addObject(contents)
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def make_revisions(pages, revisions, changed):
+    texts = ["Page {}".format(i) for i in range(pages)]
+    result = [make_pdf(texts)]
+    for revision in range(1, revisions):
+        for i in random.sample(range(pages), changed):
+            texts[i] = "Page {} (revision {})".format(i, revision)
+        result.append(make_pdf(texts))
+    return result
+
+
+def watermark(data, page_cache=None):
+    pdf_writer = PdfFileWriter()
+    merge_watermark(PdfFileReader(BytesIO(data)), pdf_writer, page_cache=page_cache)
+    buf = BytesIO()
+    pdf_writer.write(buf)
+    return buf.getvalue()
+
+
+def page_contents(data):
+    # renamed resources get random names
+    reader = PdfFileReader(BytesIO(data))
+    return [
+        re.sub(
+            rb"[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}",
+            b"",
+            page.getContents().getData(),
+        )
+        for page in (reader.getPage(i) for i in range(reader.numPages))
+    ]
+
+
+def run(revisions, cache, editable):
+    version = watermark_template.version
+    plain = reused = 0
+    merged_pages = reused_pages = 0
+    for data in revisions:
+        start = time.perf_counter()
+        expected = watermark(data)
+        plain += time.perf_counter() - start
+
+        start = time.perf_counter()
+        page_cache = WatermarkedPages(version, cache.get_pages("bench", editable))
+        result = watermark(data, page_cache)
+        cache.set_pages("bench", editable, page_cache.added, page_cache.reused)
+        reused += time.perf_counter() - start
+        merged_pages += page_cache.num_merged
+        reused_pages += page_cache.num_reused
+        assert page_contents(result) == page_contents(expected)
+    return plain, reused, merged_pages, reused_pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[20, 100, 300])
+    parser.add_argument("--revisions", type=int, default=5)
+    parser.add_argument("--changed", type=int, default=3, help="Pages per revision")
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(
+        "{:>6} {:>10} {:>8} {:>8} {:>12} {:>12} {:>8}".format(
+            "pages",
+            "revisions",
+            "merged",
+            "reused",
+            "plain s",
+            "reuse s",
+            "speedup",
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = WatermarkCache()
+        cache.configure(os.path.join(tmpdir, "cache.db"), 1000, 3600, 100000)
+        for pages in args.pages:
+            revisions = make_revisions(pages, args.revisions, min(args.changed, pages))
+            plain, reused, merged_pages, reused_pages = run(
+                revisions, cache, "{}/paper".format(pages)
+            )
+            print(
+                "{:>6} {:>10} {:>8} {:>8} {:>12.2f} {:>12.2f} {:>7.2f}x".format(
+                    pages,
+                    len(revisions),
+                    merged_pages,
+                    reused_pages,
+                    plain,
+                    reused,
+                    plain / reused,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
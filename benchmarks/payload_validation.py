@@ -0,0 +1,110 @@
+"""Compare loading webhook payloads with marshmallow and the fast path.
+
+Uses `review_editable` and `get_custom_revision_actions` payloads with a
+varying number of files and tags, and checks that both ways of loading
+them give the same result.
+
+    python benchmarks/payload_validation.py
+"""
+
+import timeit
+from copy import deepcopy
+
+from openreferee_server.schemas import (
+    review_editable_schema,
+    service_actions_request_schema,
+)
+from openreferee_server.validation import compile_loader
+
+
+USER = {"id": 1, "full_name": "Guinea Pig", "identifier": "User:1"}
+ENDPOINTS = {
+    "revisions": {
+        "details": "https://indico.example.com/revision/1",
+        "replace": "https://indico.example.com/revision/1/replace",
+    },
+    "file_upload": "https://indico.example.com/upload",
+}
+
+
+def make_revision(num_files, num_tags):
+    return {
+        "comment": "Please have a look",
+        "submitter": USER,
+        "editor": None,
+        "initial_state": {"name": "ready_for_review", "title": None, "css_class": ""},
+        "final_state": {"name": "accepted", "title": "Accepted", "css_class": ""},
+        "tags": [
+            {
+                "id": i,
+                "code": "TAG{}".format(i),
+                "title": "Tag {}".format(i),
+                "color": "red",
+                "system": False,
+                "verbose_title": "Tag {}".format(i),
+                "is_used_in_revision": True,
+                "url": "https://indico.example.com/tags/{}".format(i),
+            }
+            for i in range(num_tags)
+        ],
+        "files": [
+            {
+                "uuid": "00000000-0000-0000-0000-{:012}".format(i),
+                "filename": "file{}.pdf".format(i),
+                "content_type": "application/pdf",
+                "file_type": 1,
+                "signed_download_url": "https://indico.example.com/files/{}".format(i),
+                "external_download_url": "https://indico.example.com/dl/{}".format(i),
+            }
+            for i in range(num_files)
+        ],
+    }
+
+
+def make_payloads(num_files, num_tags):
+    revision = make_revision(num_files, num_tags)
+    review = {"action": "accept", "revision": revision, "endpoints": ENDPOINTS}
+    actions = {
+        "revision": deepcopy(revision),
+        "user": dict(USER, email="guinea.pig@example.com"),
+        "user_is_submitter": False,
+        "user_is_editor": True,
+    }
+    del actions["user"]["identifier"]
+    return [
+        ("review_editable", review_editable_schema, review),
+        ("get_custom_revision_actions", service_actions_request_schema, actions),
+    ]
+
+
+def main():
+    print(
+        "{:<28} {:>6} {:>5} {:>15} {:>12} {:>8}".format(
+            "payload", "files", "tags", "marshmallow µs", "fast µs", "speedup"
+        )
+    )
+    for num_files, num_tags in ((1, 0), (5, 5), (50, 20), (500, 50)):
+        for name, schema, payload in make_payloads(num_files, num_tags):
+            fast_load = compile_loader(schema)
+            assert fast_load(payload) == schema.load(payload), name
+            number = max(10, 2000 // (num_files + num_tags))
+            slow = min(
+                timeit.repeat(lambda: schema.load(payload), number=number, repeat=5)
+            )
+            fast = min(
+                timeit.repeat(lambda: fast_load(payload), number=number, repeat=5)
+            )
+            print(
+                "{:<28} {:>6} {:>5} {:>15.1f} {:>12.1f} {:>7.1f}x".format(
+                    name,
+                    num_files,
+                    num_tags,
+                    slow / number * 1e6,
+                    fast / number * 1e6,
+                    slow / fast,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compare watermarking PDFs with and without pipelining the upload.
+
+The fake Indico reads uploads at a limited bandwidth, so sending a file
+takes about as long as writing it.  Without pipelining, `process_pdf`
+watermarks and writes the whole document before starting the upload; with
+it, every page is written as soon as it has been watermarked while the
+upload is running, so the wall-clock time should approach the larger of
+the two instead of their sum.
+
+    python benchmarks/pipelined_upload.py --pages 100 500 --bandwidth 0.5
+"""
+
+import argparse
+import os
+import time
+from io import BytesIO
+
+import requests
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+
+from fake_indico import FakeIndico
+from openreferee_server.app import create_app
+from openreferee_server.models import EventRecord
+from openreferee_server.operations import process_pdf
+
+
+def make_pdf(pages, lines=40):
+    writer = PdfFileWriter()
+    for i in range(pages):
+        page = writer.addBlankPage(595, 842)
+        contents = DecodedStreamObject()
+        contents.setData(
+            b"".join(
+                b"BT /F1 10 Tf 50 %d Td (Page %d, line %d) Tj ET\n"
+                % (800 - j * 18, i, j)
+                for j in range(lines)
+            )
+        )
+        page[NameObject("/Contents")] = writer._addObject(contents)
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def run(app, indico, pages, pipelined, repeat):
+    app.config["PDF_PIPELINE_UPLOAD"] = pipelined
+    event = EventRecord("bench", indico.base_url, "token", {})
+    file = {
+        "filename": "paper.pdf",
+        "content_type": "application/pdf",
+        "signed_download_url": indico.add_file("paper.pdf", make_pdf(pages)),
+    }
+    upload_endpoint = indico.editable_endpoints("bench", 1)["file_upload"]
+    timings = []
+    sizes = set()
+    with app.app_context(), requests.Session() as session:
+        for __ in range(repeat):
+            start = time.perf_counter()
+            upload = process_pdf(event, file, session, upload_endpoint)
+            timings.append(time.perf_counter() - start)
+            sizes.add(indico.uploads[upload["uuid"]])
+    assert len(sizes) == 1, sizes
+    return min(timings), sizes.pop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.5,
+        help="MB/s the fake Indico reads uploads with",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ["WATERMARK_CACHE_PATH"] = ""
+    indico = FakeIndico(bandwidth=args.bandwidth * 1024 * 1024).start()
+    app = create_app()
+    print(
+        "{:>6} {:>10} {:>14} {:>14} {:>8}".format(
+            "pages", "size MB", "sequential s", "pipelined s", "speedup"
+        )
+    )
+    try:
+        for pages in args.pages:
+            sequential, size = run(app, indico, pages, False, args.repeat)
+            pipelined, __ = run(app, indico, pages, True, args.repeat)
+            print(
+                "{:>6} {:>10.1f} {:>14.2f} {:>14.2f} {:>7.2f}x".format(
+                    pages,
+                    size / 1024 / 1024,
+                    sequential,
+                    pipelined,
+                    sequential / pipelined,
+                )
+            )
+    finally:
+        indico.stop()
+
+
+if __name__ == "__main__":
+    main()
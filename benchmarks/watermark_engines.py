@@ -0,0 +1,99 @@
+"""Compare the engines adding the watermark to the pages of a document.
+
+The ``merge`` engine merges the content streams and resources of the
+watermark into every page, which means decoding, parsing and serializing
+the content of each page and writing it uncompressed.  The ``overlay``
+engine adds the watermark to the document once as a form and only appends
+a reference to it to every page.  The time to watermark and write the
+documents is reported, along with how much the output grew compared to
+the source per page.
+
+    python benchmarks/watermark_engines.py --pages 10 100 500
+"""
+
+import argparse
+import time
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+
+from openreferee_server.watermark import merge_watermark
+
+
+def make_pdf(pages, lines=40):
+    writer = PdfFileWriter()
+    for i in range(pages):
+        page = writer.addBlankPage(595, 842)
+        contents = DecodedStreamObject()
+        contents.setData(
+            b"".join(
+                b"BT /F1 10 Tf 50 %d Td (Page %d, line %d) Tj ET\n"
+                % (800 - j * 18, i, j)
+                for j in range(lines)
+            )
+        )
+        # like in most documents, the content streams are compressed
+        page[NameObject("/Contents")] = writer._addObject(contents.flateEncode())
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def watermark(data, engine):
+    pdf_writer = PdfFileWriter()
+    merge_watermark(PdfFileReader(BytesIO(data)), pdf_writer, engine=engine)
+    buf = BytesIO()
+    pdf_writer.write(buf)
+    return buf.getvalue()
+
+
+def run(data, engine, repeat):
+    timings = []
+    for __ in range(repeat):
+        start = time.perf_counter()
+        result = watermark(data, engine)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        "{:>6} {:>10} {:>10} {:>8} {:>14} {:>14}".format(
+            "pages",
+            "merge s",
+            "overlay s",
+            "speedup",
+            "merge B/page",
+            "overlay B/page",
+        )
+    )
+    for pages in args.pages:
+        data = make_pdf(pages)
+        merge, merged = run(data, "merge", args.repeat)
+        overlay, overlaid = run(data, "overlay", args.repeat)
+        reader = PdfFileReader(BytesIO(overlaid))
+        assert reader.numPages == pages
+        assert all(
+            "/OpenRefereeWatermark" in reader.getPage(i)["/Resources"]["/XObject"]
+            for i in range(pages)
+        )
+        print(
+            "{:>6} {:>10.2f} {:>10.2f} {:>7.2f}x {:>14.0f} {:>14.0f}".format(
+                pages,
+                merge,
+                overlay,
+                merge / overlay,
+                (len(merged) - len(data)) / pages,
+                (len(overlaid) - len(data)) / pages,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
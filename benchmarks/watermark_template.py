@@ -0,0 +1,74 @@
+"""Measure the per-file overhead of obtaining the watermark page.
+
+Compares re-parsing ``watermark.pdf`` for every file (what ``process_pdf``
+used to do) with copying the page from the cached `WatermarkTemplate`, and
+the full watermarking of a small document with both approaches.
+
+    python benchmarks/watermark_template.py
+"""
+
+import timeit
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+from openreferee_server.watermark import WATERMARK_PATH, WatermarkTemplate
+
+
+def make_document(pages):
+    writer = PdfFileWriter()
+    for __ in range(pages):
+        writer.addBlankPage(595, 842)
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def parse_watermark():
+    with WATERMARK_PATH.open("rb") as f:
+        page = PdfFileReader(f).getPage(0)
+        # make sure the page is actually read while the file is open
+        page.getContents()
+        page["/Resources"].getObject()
+        return page
+
+
+def watermark_document(data, watermark_page):
+    reader = PdfFileReader(BytesIO(data))
+    writer = PdfFileWriter()
+    for i in range(reader.numPages):
+        page = reader.getPage(i)
+        page.mergePage(watermark_page)
+        writer.addPage(page)
+    writer.write(BytesIO())
+
+
+def watermark_reparse(data):
+    with WATERMARK_PATH.open("rb") as f:
+        watermark_document(data, PdfFileReader(f).getPage(0))
+
+
+def watermark_cached(data, template):
+    watermark_document(data, template.get_page())
+
+
+def bench(label, fn, number):
+    best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print("{:<40} {:>10.3f} ms".format(label, best * 1000))
+
+
+def main():
+    template = WatermarkTemplate(WATERMARK_PATH)
+    template.get_page()
+    document = make_document(10)
+
+    print("Obtaining the watermark page (per file)")
+    bench("  parse watermark.pdf", parse_watermark, 200)
+    bench("  copy from cached template", template.get_page, 200)
+    print("Watermarking a 10-page document (per file)")
+    bench("  parse watermark.pdf", lambda: watermark_reparse(document), 20)
+    bench("  cached template", lambda: watermark_cached(document, template), 20)
+
+
+if __name__ == "__main__":
+    main()
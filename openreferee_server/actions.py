@@ -0,0 +1,230 @@
+"""Custom actions offered on the timeline of a revision.
+
+Each action declares when it is available (to editors only, in which
+final states of the revision, depending on which tags the revision has)
+and a function applying it.  Which actions are available only depends on
+a small decision key, so the registry precomputes the available actions,
+their serialized form and the rendered response for every possible key.
+"""
+
+import hashlib
+import json
+import threading
+from itertools import combinations
+
+from .defaults import CUSTOM_ACTIONS
+from .schemas import service_actions_schema
+
+
+class CustomAction:
+    """A custom action shown as a button on the timeline.
+
+    :param name: the unique name of the action
+    :param title, color, icon, confirm: how the button is shown in Indico
+    :param apply: a function taking the revision and the tag catalog of the
+                  event and returning the ``ServiceActionResultSchema`` data
+    :param editor_only: only offer the action to editors
+    :param states: the final states of the revision in which the action is
+                   available (any state if not set)
+    :param excluded_states: the final states in which it is not available
+    :param with_tags: tag codes the revision must have
+    :param without_tags: tag codes the revision must not have
+    :param needs_tags: tag codes `apply` needs from the tag catalog
+    """
+
+    def __init__(
+        self,
+        name,
+        title,
+        apply,
+        *,
+        color=None,
+        icon=None,
+        confirm=None,
+        editor_only=False,
+        states=None,
+        excluded_states=(),
+        with_tags=(),
+        without_tags=(),
+        needs_tags=(),
+    ):
+        self.name = name
+        self.title = title
+        self.color = color
+        self.icon = icon
+        self.confirm = confirm
+        self.apply = apply
+        self.editor_only = editor_only
+        self.states = frozenset(states) if states is not None else None
+        self.excluded_states = frozenset(excluded_states)
+        self.with_tags = frozenset(with_tags)
+        self.without_tags = frozenset(without_tags)
+        self.needs_tags = frozenset(needs_tags)
+
+    def __repr__(self):
+        return f"<CustomAction({self.name})>"
+
+    @property
+    def display(self):
+        """The data describing the button of the action."""
+        data = {"name": self.name, "title": self.title}
+        for key in ("color", "icon", "confirm"):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        return data
+
+    def is_available(self, user_is_editor, state, tag_codes):
+        if self.editor_only and not user_is_editor:
+            return False
+        if self.states is not None and state not in self.states:
+            return False
+        if state in self.excluded_states:
+            return False
+        return self.with_tags <= tag_codes and not (self.without_tags & tag_codes)
+
+
+class ActionRegistry:
+    """The custom actions of the service and when they are available.
+
+    The decision key of a revision consists of whether the user is an
+    editor, its final state (if any action depends on it) and which of the
+    tags the actions depend on it has.  The table mapping each possible key
+    to the available actions is built on first use and rebuilt whenever an
+    action is registered.
+    """
+
+    def __init__(self):
+        self._actions = {}
+        self._lock = threading.Lock()
+        # (states, tag codes, table) the decision keys are built from
+        self._table = None
+
+    def register(self, action):
+        with self._lock:
+            self._actions[action.name] = action
+            self._table = None
+        return action
+
+    def action(self, name, title, **kwargs):
+        """Register the decorated function as the `apply` of an action."""
+
+        def decorator(fn):
+            self.register(CustomAction(name, title, fn, **kwargs))
+            return fn
+
+        return decorator
+
+    def get(self, name):
+        return self._actions.get(name)
+
+    def _build_table(self):
+        actions = list(self._actions.values())
+        states = frozenset().union(
+            *(a.states or () for a in actions), *(a.excluded_states for a in actions)
+        )
+        tags = frozenset().union(
+            *(a.with_tags for a in actions), *(a.without_tags for a in actions)
+        )
+        tag_sets = [
+            frozenset(subset)
+            for size in range(len(tags) + 1)
+            for subset in combinations(sorted(tags), size)
+        ]
+        table = {}
+        for user_is_editor in (False, True):
+            # `None` stands for all the states no action depends on
+            for state in (*states, None):
+                for tag_codes in tag_sets:
+                    available = [
+                        a
+                        for a in actions
+                        if a.is_available(user_is_editor, state, tag_codes)
+                    ]
+                    table[(user_is_editor, state, tag_codes)] = self._make_entry(
+                        available
+                    )
+        return states, tags, table
+
+    def _make_entry(self, available):
+        data = service_actions_schema.dump([a.display for a in available])
+        body = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+        return available, data, body, hashlib.sha256(body).hexdigest()
+
+    def _get_table(self):
+        table = self._table
+        if table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._build_table()
+                table = self._table
+        return table
+
+    def _lookup(self, revision, user_is_editor):
+        states, tags, table = self._get_table()
+        state = revision["final_state"]["name"]
+        tag_codes = {t["code"] for t in revision["tags"]}
+        key = (
+            bool(user_is_editor),
+            state if state in states else None,
+            tags.intersection(tag_codes),
+        )
+        return table[key]
+
+    def available(self, revision, user_is_editor):
+        return self._lookup(revision, user_is_editor)[0]
+
+    def dump_available(self, revision, user_is_editor):
+        """Get the serialized ``ServiceActionSchema`` list of available actions."""
+        return self._lookup(revision, user_is_editor)[1]
+
+    def render_available(self, revision, user_is_editor):
+        """Get the available actions as a JSON response body.
+
+        :return: a ``(body, etag)`` tuple; the ETag is a hash of the body
+        """
+        return self._lookup(revision, user_is_editor)[2:]
+
+    def is_available(self, revision, name, user_is_editor):
+        action = self._actions.get(name)
+        return action is not None and action in self.available(revision, user_is_editor)
+
+
+registry = ActionRegistry()
+_display = {a["name"]: a for a in CUSTOM_ACTIONS}
+
+
+@registry.action(
+    **_display["fail-qa"],
+    editor_only=True,
+    states={"accepted"},
+    with_tags={"QA_APPROVED"},
+)
+def fail_qa(revision, available_tags):
+    return {
+        "tags": [],
+        "publish": False,
+        "comments": [{"internal": True, "text": "QA failed; unpublishing it"}],
+    }
+
+
+@registry.action(
+    **_display["approve-qa"],
+    editor_only=True,
+    states={"accepted"},
+    without_tags={"QA_APPROVED"},
+    needs_tags={"QA_APPROVED"},
+)
+def approve_qa(revision, available_tags):
+    return {
+        "tags": [available_tags["QA_APPROVED"]["id"]],
+        "publish": True,
+        "comments": [{"internal": True, "text": "QA ok; publishing it"}],
+    }
+
+
+@registry.action(**_display["lol"], editor_only=True, excluded_states={"accepted"})
+def lol(revision, available_tags):
+    return {
+        "redirect": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "comments": [{"internal": True, "text": "Nice try. How about no?"}],
+    }
@@ -0,0 +1,125 @@
+"""Admission control for the webhooks.
+
+When Indico sends many webhooks at once (e.g. when judging many revisions),
+every request ties up a thread waiting for Indico, and once too many of
+them pile up all requests slow down until they time out and are retried.
+To shed load instead, only a limited number of requests for the same event
+and in total are processed at the same time; further requests are rejected
+right away with a ``Retry-After`` header, a 429 if their event already has
+too many requests in flight or a 503 if the whole service does.
+
+The limits apply per process, so with several processes the total number
+of requests processed is a multiple of them.
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from .metrics import CallbackMetric, Counter
+
+
+webhook_rejections = Counter(
+    "openreferee_webhook_rejections_total",
+    "Webhook requests rejected because too many requests were in flight",
+    ("endpoint", "limit"),
+)
+
+
+class ConcurrencyLimiter:
+    """Count the requests in flight and reject those exceeding the limits.
+
+    Requests are never queued: a request which would exceed a limit is
+    rejected immediately, so this can be used from threads and coroutines
+    alike.
+    """
+
+    def __init__(self, max_in_flight=0, max_in_flight_per_event=0, retry_after=5):
+        self._lock = threading.Lock()
+        # event identifier -> number of requests in flight
+        self._events = {}
+        self.in_flight = 0
+        self.configure(max_in_flight, max_in_flight_per_event, retry_after)
+
+    def configure(self, max_in_flight, max_in_flight_per_event, retry_after):
+        """Set the limits, 0 meaning no limit."""
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_event = max_in_flight_per_event
+        self.retry_after = retry_after
+
+    def acquire(self, identifier, endpoint):
+        """Count a request for an event as in flight.
+
+        :raise TooManyRequests: if the event has too many requests in flight
+        :raise ServiceUnavailable: if there are too many requests in flight
+        """
+        with self._lock:
+            count = self._events.get(identifier, 0)
+            if self.max_in_flight_per_event and count >= self.max_in_flight_per_event:
+                limit = "event"
+            elif self.max_in_flight and self.in_flight >= self.max_in_flight:
+                limit = "global"
+            else:
+                self._events[identifier] = count + 1
+                self.in_flight += 1
+                return
+        webhook_rejections.inc(endpoint, limit)
+        if limit == "event":
+            raise TooManyRequests(
+                "Too many requests for this event are being processed",
+                retry_after=self.retry_after,
+            )
+        raise ServiceUnavailable(
+            "Too many requests are being processed", retry_after=self.retry_after
+        )
+
+    def release(self, identifier):
+        with self._lock:
+            count = self._events.pop(identifier) - 1
+            if count:
+                self._events[identifier] = count
+            self.in_flight -= 1
+
+    @contextmanager
+    def limit(self, identifier, endpoint):
+        self.acquire(identifier, endpoint)
+        try:
+            yield
+        finally:
+            self.release(identifier)
+
+    def stats(self):
+        """Count the requests in flight, and the events they are for.
+
+        The identifiers of the events are left out since the stats are
+        served without authentication.
+        """
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "events": len(self._events),
+                "max_per_event": max(self._events.values(), default=0),
+            }
+
+
+webhook_limiter = ConcurrencyLimiter()
+
+CallbackMetric(
+    "openreferee_webhooks_in_flight",
+    "Webhook requests being processed",
+    (),
+    lambda: {(): webhook_limiter.in_flight},
+)
+
+
+def limit_concurrency(fn):
+    """Apply `webhook_limiter` to a view taking an event."""
+
+    @wraps(fn)
+    def wrapper(event, **kwargs):
+        with webhook_limiter.limit(event.identifier, fn.__name__):
+            return fn(event=event, **kwargs)
+
+    return wrapper
@@ -0,0 +1,124 @@
+"""Asynchronous counterparts of the operations talking to Indico.
+
+They share the review logic with `operations` and only differ in how the
+tag catalog is fetched, using a pooled ``httpx.AsyncClient`` per event.
+"""
+
+import asyncio
+
+import httpx
+from flask import current_app
+
+from .metrics import indico_calls
+from .operations import (
+    REVISION_TAGS,
+    accepted_revision_tags,
+    apply_custom_action,
+    client_closers,
+    custom_action_tags,
+    review_accepted_revision,
+    review_revision,
+    review_revisions,
+    reviews_tags,
+    tag_cache,
+    tags_by_code,
+)
+
+
+# event identifier -> ((url, token), client, event loop of the client)
+_clients = {}
+
+
+def setup_async_client(token):
+    config = current_app.config
+    return httpx.AsyncClient(
+        headers={"Authorization": "Bearer {}".format(token)},
+        verify=not current_app.debug,
+        timeout=httpx.Timeout(
+            config["HTTP_READ_TIMEOUT"], connect=config["HTTP_CONNECT_TIMEOUT"]
+        ),
+        limits=httpx.Limits(max_connections=config["HTTP_POOL_SIZE"]),
+        # only connection failures are retried by httpx
+        transport=httpx.AsyncHTTPTransport(retries=config["HTTP_RETRIES"]),
+    )
+
+
+def get_async_client(event):
+    """Get the shared client used to talk to the Indico instance of an event.
+
+    Clients are bound to the running event loop, which is only ever used
+    from a single thread, so no locking is needed; a new one is created if
+    the token of the event changed.
+    """
+    key = (event.url, event.token)
+    entry = _clients.get(event.identifier)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    client = setup_async_client(event.token)
+    _clients[event.identifier] = (key, client, asyncio.get_event_loop())
+    if entry is not None:
+        asyncio.ensure_future(entry[1].aclose())
+    return client
+
+
+def close_async_client(event):
+    """Close the client of a removed event.
+
+    Events are removed by the Flask application, which runs in another
+    thread than the event loop, so the client is closed on its loop.
+    """
+    entry = _clients.pop(event.identifier, None)
+    if entry is not None and not entry[2].is_closed():
+        asyncio.run_coroutine_threadsafe(entry[1].aclose(), entry[2])
+
+
+client_closers.append(close_async_client)
+
+
+async def close_async_clients():
+    clients = [client for __, client, __ in _clients.values()]
+    _clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients))
+
+
+async def fetch_event_tags(client, event):
+    current_app.logger.info("Fetching available tags...")
+    with indico_calls.time("tags_list"):
+        response = await client.get(event.endpoints["tags"]["list"])
+    response.raise_for_status()
+    return tags_by_code(response.json())
+
+
+async def get_event_tags(event, require=()):
+    available_tags = tag_cache.get(event.identifier)
+    if available_tags is None or any(c not in available_tags for c in require):
+        available_tags = await fetch_event_tags(get_async_client(event), event)
+        tag_cache.set(event.identifier, available_tags)
+    return available_tags
+
+
+async def _get_required_tags(event, require):
+    if not require:
+        return {}
+    return await get_event_tags(event, require=require)
+
+
+async def process_accepted_revision(event, revision):
+    available_tags = await _get_required_tags(event, accepted_revision_tags(revision))
+    return review_accepted_revision(revision, available_tags)
+
+
+async def process_revision(event, revision, action):
+    available_tags = await _get_required_tags(event, REVISION_TAGS)
+    return review_revision(revision, action, available_tags)
+
+
+async def process_reviews(event, reviews):
+    available_tags = await _get_required_tags(event, reviews_tags(reviews))
+    return review_revisions(reviews, available_tags)
+
+
+async def process_custom_action(event, revision, action, user_is_editor):
+    required = custom_action_tags(revision, action, user_is_editor)
+    available_tags = await _get_required_tags(event, required)
+    return apply_custom_action(revision, action, user_is_editor, available_tags)
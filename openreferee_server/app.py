@@ -7,7 +7,9 @@ from flask import Flask, jsonify
 from werkzeug.exceptions import HTTPException, UnprocessableEntity
 
 from . import __version__
-from .db import db, register_db_cli
+from .db import db, init_engine, register_db_cli
+from .dedup import register_watermark_cache_cli, watermark_cache
+from .watermark import WATERMARK_ENGINES
 
 
 try:
@@ -16,21 +18,176 @@ except ImportError:
     CORS = None
 
 
+def _env_flag(name, default=False):
+    """Get a boolean option from the environment.
+
+    Empty values and ``0``, ``false``, ``no`` and ``off`` disable it.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("", "0", "false", "no", "off")
+
+
 def create_app():
+    from .jobs import register_job_cli
     from .server import api
 
     app = Flask(__name__)
     if os.environ.get("FLASK_ENABLE_CORS") and CORS is not None:
         CORS(app)
-    app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///editingsvc"
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        "SQLALCHEMY_DATABASE_URI", "postgresql:///editingsvc"
+    )
+    # connections kept open and opened on top of them under load (per process)
+    app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 5))
+    app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    # how long to wait for a connection when all of them are in use
+    app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    # replace connections older than this many seconds (-1 to keep them)
+    app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", -1))
+    # check that a connection is alive before using it
+    app.config["DB_POOL_PRE_PING"] = _env_flag("DB_POOL_PRE_PING")
+    # milliseconds, 0 for no limit; with SQLite it only limits waiting for locks
+    app.config["DB_STATEMENT_TIMEOUT"] = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0))
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["TAG_CACHE_SIZE"] = int(os.environ.get("TAG_CACHE_SIZE", 1024))
+    # seconds, 0 disables the cache
+    app.config["TAG_CACHE_TTL"] = int(os.environ.get("TAG_CACHE_TTL", 300))
+    app.config["JOB_CONCURRENCY"] = int(os.environ.get("JOB_CONCURRENCY", 4))
+    app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 10))
+    app.config["JOB_RETRY_DELAY"] = float(os.environ.get("JOB_RETRY_DELAY", 5))
+    app.config["JOB_RETRY_MAX_DELAY"] = float(
+        os.environ.get("JOB_RETRY_MAX_DELAY", 300)
+    )
+    app.config["JOB_LEASE"] = float(os.environ.get("JOB_LEASE", 600))
+    app.config["PDF_SPOOL_MAX_SIZE"] = int(
+        os.environ.get("PDF_SPOOL_MAX_SIZE", 8 * 1024 * 1024)
+    )
+    app.config["STREAM_CHUNK_SIZE"] = int(
+        os.environ.get("STREAM_CHUNK_SIZE", 64 * 1024)
+    )
+    # upload watermarked PDFs while they are being written; the upload is
+    # sent with chunked transfer encoding since its size is not known yet
+    app.config["PDF_PIPELINE_UPLOAD"] = _env_flag("PDF_PIPELINE_UPLOAD")
+    app.config["PDF_PIPELINE_BUFFER_SIZE"] = int(
+        os.environ.get("PDF_PIPELINE_BUFFER_SIZE", 4 * 1024 * 1024)
+    )
+    app.config["FILE_PROCESSING_CONCURRENCY"] = int(
+        os.environ.get("FILE_PROCESSING_CONCURRENCY", 4)
+    )
+    # documents with many pages may be watermarked in a pool of processes
+    app.config["PDF_PROCESS_POOL_SIZE"] = int(
+        os.environ.get("PDF_PROCESS_POOL_SIZE", 0)
+    )
+    app.config["PDF_PROCESS_POOL_MIN_PAGES"] = int(
+        os.environ.get("PDF_PROCESS_POOL_MIN_PAGES", 100)
+    )
+    app.config["WATERMARK_CACHE_PATH"] = os.environ.get(
+        "WATERMARK_CACHE_PATH", os.path.join(app.instance_path, "watermark-cache.db")
+    )
+    app.config["WATERMARK_CACHE_SIZE"] = int(
+        os.environ.get("WATERMARK_CACHE_SIZE", 10000)
+    )
+    app.config["WATERMARK_CACHE_MAX_AGE"] = int(
+        os.environ.get("WATERMARK_CACHE_MAX_AGE", 30 * 86400)
+    )
+    # "merge" merges the watermark into the content of every page, "overlay"
+    # draws it as a form shared by all pages, which is faster and smaller
+    app.config["WATERMARK_ENGINE"] = os.environ.get("WATERMARK_ENGINE", "merge")
+    if app.config["WATERMARK_ENGINE"] not in WATERMARK_ENGINES:
+        raise ValueError(
+            "WATERMARK_ENGINE must be one of {}".format(", ".join(WATERMARK_ENGINES))
+        )
+    # only merge the watermark into the pages which changed since a previous
+    # revision of the same editable; needs the watermark cache and the merge
+    # engine
+    app.config["WATERMARK_REUSE_PAGES"] = _env_flag("WATERMARK_REUSE_PAGES")
+    app.config["WATERMARK_PAGE_CACHE_SIZE"] = int(
+        os.environ.get("WATERMARK_PAGE_CACHE_SIZE", 100000)
+    )
+    app.config["HTTP_POOL_SIZE"] = int(os.environ.get("HTTP_POOL_SIZE", 10))
+    app.config["HTTP_RETRIES"] = int(os.environ.get("HTTP_RETRIES", 3))
+    app.config["HTTP_RETRY_BACKOFF"] = float(os.environ.get("HTTP_RETRY_BACKOFF", 0.5))
+    app.config["HTTP_CONNECT_TIMEOUT"] = float(
+        os.environ.get("HTTP_CONNECT_TIMEOUT", 5)
+    )
+    app.config["HTTP_READ_TIMEOUT"] = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+    app.config["PROVISION_ASYNC"] = _env_flag("PROVISION_ASYNC")
+    app.config["PROVISIONING_CONCURRENCY"] = int(
+        os.environ.get("PROVISIONING_CONCURRENCY", 4)
+    )
+    app.config["EVENT_CACHE_SIZE"] = int(os.environ.get("EVENT_CACHE_SIZE", 1024))
+    # other processes may have removed an event, so don't trust the cache for
+    # long; 0 disables the cache
+    app.config["EVENT_CACHE_TTL"] = int(os.environ.get("EVENT_CACHE_TTL", 60))
+    # responses to webhooks are replayed to retries within this many seconds
+    app.config["IDEMPOTENCY_WINDOW"] = int(os.environ.get("IDEMPOTENCY_WINDOW", 600))
+    app.config["IDEMPOTENCY_CACHE_SIZE"] = int(
+        os.environ.get("IDEMPOTENCY_CACHE_SIZE", 1024)
+    )
+    # how long a retry waits for the original request to finish
+    app.config["IDEMPOTENCY_WAIT"] = float(os.environ.get("IDEMPOTENCY_WAIT", 30))
+    # after this many seconds an unfinished request is assumed to have died
+    app.config["IDEMPOTENCY_LEASE"] = int(os.environ.get("IDEMPOTENCY_LEASE", 300))
+    # threads of the ASGI app storing keys, each may wait for another process
+    app.config["IDEMPOTENCY_DB_THREADS"] = int(
+        os.environ.get("IDEMPOTENCY_DB_THREADS", 4)
+    )
+    # webhook requests processed at the same time (per process), in total and
+    # for the same event; further requests are rejected until one finishes
+    app.config["WEBHOOK_MAX_IN_FLIGHT"] = int(
+        os.environ.get("WEBHOOK_MAX_IN_FLIGHT", 64)
+    )
+    app.config["WEBHOOK_MAX_IN_FLIGHT_PER_EVENT"] = int(
+        os.environ.get("WEBHOOK_MAX_IN_FLIGHT_PER_EVENT", 16)
+    )
+    # seconds after which Indico should retry a rejected request
+    app.config["WEBHOOK_RETRY_AFTER"] = int(os.environ.get("WEBHOOK_RETRY_AFTER", 5))
+    app.config["BULK_REVIEW_MAX_SIZE"] = int(
+        os.environ.get("BULK_REVIEW_MAX_SIZE", 1000)
+    )
+    # load webhook payloads without marshmallow if they are well-formed
+    app.config["FAST_PAYLOAD_VALIDATION"] = _env_flag("FAST_PAYLOAD_VALIDATION", True)
     register_error_handlers(app)
+    register_caches(app)
     db.init_app(app)
+    init_engine(app)
     register_db_cli(app)
+    register_job_cli(app)
+    register_watermark_cache_cli(app)
     app.register_blueprint(api)
     return app
 
 
+def register_caches(app):
+    from .admission import webhook_limiter
+    from .idempotency import response_cache
+    from .operations import event_cache, tag_cache
+
+    event_cache.configure(
+        maxsize=app.config["EVENT_CACHE_SIZE"], ttl=app.config["EVENT_CACHE_TTL"]
+    )
+    tag_cache.configure(
+        maxsize=app.config["TAG_CACHE_SIZE"], ttl=app.config["TAG_CACHE_TTL"]
+    )
+    response_cache.configure(
+        maxsize=app.config["IDEMPOTENCY_CACHE_SIZE"],
+        ttl=app.config["IDEMPOTENCY_WINDOW"],
+    )
+    watermark_cache.configure(
+        app.config["WATERMARK_CACHE_PATH"],
+        app.config["WATERMARK_CACHE_SIZE"],
+        app.config["WATERMARK_CACHE_MAX_AGE"],
+        app.config["WATERMARK_PAGE_CACHE_SIZE"],
+    )
+    webhook_limiter.configure(
+        app.config["WEBHOOK_MAX_IN_FLIGHT"],
+        app.config["WEBHOOK_MAX_IN_FLIGHT_PER_EVENT"],
+        app.config["WEBHOOK_RETRY_AFTER"],
+    )
+
+
 def register_spec(test=False, test_host="localhost", test_port=12345):
     servers = (
         [{"url": f"http://{test_host}:{test_port}", "description": "Test server"}]
@@ -77,7 +234,9 @@ def register_error_handlers(app):
 
     @app.errorhandler(HTTPException)
     def _handle_http_exception(exc):
-        return jsonify(error=exc.description), exc.code
+        # keep headers such as Retry-After, but not the HTML content type
+        headers = [(k, v) for k, v in exc.get_headers() if k != "Content-Type"]
+        return jsonify(error=exc.description), exc.code, headers
 
     @app.errorhandler(Exception)
     def _handle_exception(exc):
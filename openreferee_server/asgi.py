@@ -0,0 +1,211 @@
+"""ASGI entry point serving the webhooks which call back to Indico.
+
+Reviewing a revision and triggering a custom action are handled by
+coroutines using the operations from `aio`, so waiting for Indico does not
+tie up a thread.  All other requests are passed on to the regular Flask
+application.  Run it with an ASGI server, e.g.::
+
+    uvicorn --factory openreferee_server.asgi:create_asgi_app
+"""
+
+import asyncio
+import json
+import re
+import time
+from contextlib import ExitStack
+from functools import partial
+
+from asgiref.wsgi import WsgiToAsgi
+from marshmallow import ValidationError
+from werkzeug.exceptions import BadRequest, HTTPException
+
+from . import aio
+from .admission import webhook_limiter
+from .app import create_app
+from .db import db
+from .idempotency import process_idempotent
+from .metrics import http_requests
+from .schemas import (
+    bulk_review_editables_schema,
+    review_editable_schema,
+    review_response_schema,
+    service_action_result_schema,
+    service_trigger_action_request_schema,
+)
+from .server import authenticate_event
+from .validation import load_payload
+
+
+_REVISION_PATH = (
+    r"/event/(?P<identifier>[^/]+)/editable/(?P<editable_type>paper|slides|poster)"
+    r"/(?P<contrib_id>[^/]+)/(?P<revision_id>[^/]+)"
+)
+
+
+async def review_editable(app, event, payload, contrib_id, editable_type, revision_id):
+    data = load_payload(review_editable_schema, payload)
+    app.logger.info(
+        "A new revision %r was submitted for contribution %r", revision_id, contrib_id
+    )
+    revision = data["revision"]
+    if revision["final_state"]["name"] == "accepted":
+        resp = await aio.process_accepted_revision(event, revision)
+    else:
+        resp = await aio.process_revision(event, revision, data["action"])
+    return 201, review_response_schema.dump(resp)
+
+
+async def review_editables(app, event, payload):
+    data = load_payload(bulk_review_editables_schema, payload)
+    reviews = data["reviews"]
+    if len(reviews) > app.config["BULK_REVIEW_MAX_SIZE"]:
+        raise BadRequest("Too many revisions")
+    app.logger.info("%d new revisions were submitted", len(reviews))
+    resp = await aio.process_reviews(event, reviews)
+    return 201, review_response_schema.dump(resp, many=True)
+
+
+async def custom_revision_action(
+    app, event, payload, contrib_id, editable_type, revision_id
+):
+    data = load_payload(service_trigger_action_request_schema, payload)
+    resp = await aio.process_custom_action(
+        event, data["revision"], data["action"], data["user_is_editor"]
+    )
+    return 200, service_action_result_schema.dump(resp)
+
+
+class AsyncWebhookApp:
+    """Serve the slow webhooks asynchronously and everything else via WSGI."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = WsgiToAsgi(app)
+        self.routes = [
+            (re.compile(_REVISION_PATH), review_editable),
+            (re.compile(_REVISION_PATH + "/action"), custom_revision_action),
+            (re.compile(r"/event/(?P<identifier>[^/]+)/reviews"), review_editables),
+        ]
+        # handlers subject to `webhook_limiter` and to the suppression of
+        # duplicates, like their Flask views
+        self.limited = {review_editable, custom_revision_action}
+        self.idempotent = {review_editable}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] == "http" and scope["method"] == "POST":
+            for pattern, handler in self.routes:
+                match = pattern.fullmatch(scope["path"])
+                if match:
+                    return await self._handle(
+                        handler, match.groupdict(), scope, receive, send
+                    )
+        await self.wsgi_app(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                with self.app.app_context():
+                    await aio.close_async_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _authenticate(self, identifier, auth):
+        # a cache miss hits the database, so this runs in a thread
+        with self.app.app_context():
+            try:
+                return authenticate_event(identifier, auth)
+            finally:
+                db.session.remove()
+
+    async def _handle(self, handler, kwargs, scope, receive, send):
+        start = time.perf_counter()
+        body = await _read_body(receive)
+        headers = dict(scope["headers"])
+        auth = headers.get(b"authorization", b"").decode("latin-1")
+        loop = asyncio.get_event_loop()
+        response_headers = []
+        with self.app.app_context():
+            try:
+                identifier = kwargs.pop("identifier")
+                event = await loop.run_in_executor(
+                    None, self._authenticate, identifier, auth
+                )
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    raise BadRequest("Invalid JSON body.")
+                call = partial(self._call, handler, event, payload, kwargs)
+                with ExitStack() as stack:
+                    if handler in self.limited:
+                        stack.enter_context(
+                            webhook_limiter.limit(event.identifier, handler.__name__)
+                        )
+                    if (
+                        handler in self.idempotent
+                        and self.app.config["IDEMPOTENCY_WINDOW"]
+                    ):
+                        response, replayed = await process_idempotent(
+                            event, kwargs, body, call
+                        )
+                        if replayed:
+                            response_headers.append(("Idempotent-Replayed", "true"))
+                    else:
+                        response = await call()
+            except ValidationError as exc:
+                response = _json_response(
+                    422, {"webargs_errors": {"json": exc.messages}}
+                )
+            except HTTPException as exc:
+                response = _json_response(exc.code, {"error": exc.description})
+                response_headers = [
+                    (k, v) for k, v in exc.get_headers() if k != "Content-Type"
+                ]
+            except Exception:
+                self.app.logger.exception("Request failed")
+                response = _json_response(500, {"error": "Internal error"})
+        await _send_response(send, *response, response_headers)
+        http_requests.observe(
+            time.perf_counter() - start, handler.__name__, response[0]
+        )
+
+    async def _call(self, handler, event, payload, kwargs):
+        status, data = await handler(self.app, event, payload, **kwargs)
+        return _json_response(status, data)
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def _json_response(status, data):
+    return status, "application/json", json.dumps(data)
+
+
+async def _send_response(send, status, content_type, body, headers=()):
+    body = body.encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+                *((k.lower().encode(), v.encode()) for k, v in headers),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app():
+    return AsyncWebhookApp(create_app())
@@ -1,7 +1,61 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.pool import QueuePool
 
 
-db = SQLAlchemy()
+class _SQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        config = app.config
+        if sa_url.get_backend_name() == "sqlite":
+            if is_in_memory(sa_url):
+                # all threads share the one connection to the database
+                return sa_url, options
+            connect_args = options.setdefault("connect_args", {})
+            connect_args["check_same_thread"] = False
+            if config["DB_STATEMENT_TIMEOUT"]:
+                # statements can only wait for locks held by other connections
+                connect_args["timeout"] = config["DB_STATEMENT_TIMEOUT"] / 1000
+            options["poolclass"] = QueuePool
+        elif sa_url.get_backend_name() == "postgresql":
+            if config["DB_STATEMENT_TIMEOUT"]:
+                options.setdefault("connect_args", {})[
+                    "options"
+                ] = "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT"])
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+        options["pool_timeout"] = config["DB_POOL_TIMEOUT"]
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+        options["pool_pre_ping"] = config["DB_POOL_PRE_PING"]
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", _configure_sqlite_connection)
+        return engine
+
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers don't block the writer and vice versa, which matters since the
+    # worker writes while the server handles requests
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # needed for the cascades when removing an event
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def is_in_memory(sa_url):
+    return sa_url.get_backend_name() == "sqlite" and sa_url.database in (
+        None,
+        "",
+        ":memory:",
+    )
+
+
+db = _SQLAlchemy()
 db.Model.metadata.naming_convention = {
     "fk": "fk_%(table_name)s_%(column_names)s_%(referred_table_name)s",
     "pk": "pk_%(table_name)s",
@@ -15,6 +69,67 @@ db.Model.metadata.naming_convention = {
 }
 
 
+def describe_engine(engine):
+    """Describe the database and the effective pool configuration."""
+    pool = engine.pool
+    info = {
+        "database": engine.url.render_as_string(hide_password=True),
+        "pool": type(pool).__name__,
+    }
+    if isinstance(pool, QueuePool):
+        info.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            timeout=pool.timeout(),
+            recycle=pool._recycle,
+            pre_ping=pool._pre_ping,
+        )
+    return info
+
+
+def init_engine(app):
+    """Create the engine and log its configuration.
+
+    An in-memory database starts out empty, so its tables are created.
+    """
+    with app.app_context():
+        engine = db.engine
+        if is_in_memory(engine.url):
+            db.create_all()
+    info = describe_engine(engine)
+    app.logger.info(
+        "Database engine: %s", ", ".join("{}={}".format(k, v) for k, v in info.items())
+    )
+
+
+# columns added to existing tables, as (table, column, definition); existing
+# rows get the default of the definition
+_ADDED_COLUMNS = [
+    ("events", "provisioning_state", "VARCHAR(7) NOT NULL DEFAULT 'done'"),
+    ("events", "provisioning_error", "VARCHAR"),
+]
+
+
+def upgrade_schema():
+    """Create missing tables and add missing columns to existing ones.
+
+    This can be run any number of times.
+
+    :return: the names of the columns which were added
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    for table, column, definition in _ADDED_COLUMNS:
+        if column not in {c["name"] for c in inspector.get_columns(table)}:
+            db.session.execute(
+                "ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition)
+            )
+            added.append("{}.{}".format(table, column))
+    db.session.commit()
+    return added
+
+
 def register_db_cli(app):
     @app.cli.group("db")
     def cli():
@@ -24,3 +139,18 @@ def register_db_cli(app):
     def create():
         """Create the database tables."""
         db.create_all()
+
+    @cli.command()
+    def upgrade():
+        """Add the tables and columns missing in an existing database."""
+        added = upgrade_schema()
+        print("Added columns: {}".format(", ".join(added)) if added else "Up to date")
+
+    @cli.command()
+    def info():
+        """Show the database and connection pool configuration."""
+        for key, value in describe_engine(db.engine).items():
+            print("{}: {}".format(key, value))
+        if db.engine.dialect.name == "sqlite":
+            mode = db.session.execute("PRAGMA journal_mode").scalar()
+            print("journal_mode: {}".format(mode))
@@ -0,0 +1,245 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import click
+
+
+class WatermarkCache:
+    """An on-disk cache of files which have already been watermarked.
+
+    Entries map the hash of a source file, its name and content type and
+    the version of the watermark to the UUID of the watermarked file
+    uploaded to an event, so the same file is never watermarked and
+    uploaded twice.  Only uploads which were attached to a revision are
+    stored.  The store is a SQLite
+    file bounded both in age and in number of entries.
+
+    It also stores the watermarked content of the pages of each editable,
+    so pages which did not change in a new revision can be reused (see
+    `WatermarkedPages`).
+    """
+
+    def __init__(self):
+        self.path = None
+        self.max_entries = None
+        self.max_pages = None
+        self.max_age = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._writes = 0
+
+    def configure(self, path, max_entries, max_age, max_pages):
+        with self._lock:
+            self.path = path
+            self.max_entries = max_entries
+            self.max_pages = max_pages
+            self.max_age = max_age
+            self._local = threading.local()
+            self._initialized = False
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if not self._initialized and directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            if not self._initialized:
+                self._create_table(conn)
+                self._initialized = True
+        return conn
+
+    def _create_table(self, conn):
+        with conn:
+            # superseded by `watermarked_uploads`, which also stores the name
+            # and content type of the uploaded file
+            conn.execute("DROP TABLE IF EXISTS watermarked_files")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarked_uploads ("
+                "event TEXT NOT NULL, source_hash TEXT NOT NULL, "
+                "version TEXT NOT NULL, filename TEXT NOT NULL, "
+                "content_type TEXT NOT NULL, uuid TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "PRIMARY KEY (event, source_hash, version, filename, content_type))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_watermarked_uploads_created "
+                "ON watermarked_uploads (created)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarked_pages ("
+                "event TEXT NOT NULL, editable TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, content BLOB NOT NULL, "
+                "renames TEXT NOT NULL, created REAL NOT NULL, "
+                "PRIMARY KEY (event, editable, fingerprint))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_watermarked_pages_created "
+                "ON watermarked_pages (created)"
+            )
+
+    def get(self, event_id, source_hash, version, filename, content_type):
+        if not self.enabled:
+            return None
+        row = (
+            self._connect()
+            .execute(
+                "SELECT uuid FROM watermarked_uploads "
+                "WHERE event = ? AND source_hash = ? AND version = ? "
+                "AND filename = ? AND content_type = ? AND created > ?",
+                (
+                    event_id,
+                    source_hash,
+                    version,
+                    filename,
+                    content_type,
+                    time.time() - self.max_age,
+                ),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def set(self, event_id, source_hash, version, filename, content_type, uuid):
+        if not self.enabled:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO watermarked_uploads "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    event_id,
+                    source_hash,
+                    version,
+                    filename,
+                    content_type,
+                    uuid,
+                    time.time(),
+                ),
+            )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def get_pages(self, event_id, editable):
+        """Get the watermarked pages of an editable.
+
+        :return: a dict mapping page fingerprints to ``(content, renames)``
+                 tuples
+        """
+        if not self.enabled:
+            return {}
+        rows = self._connect().execute(
+            "SELECT fingerprint, content, renames FROM watermarked_pages "
+            "WHERE event = ? AND editable = ? AND created > ?",
+            (event_id, editable, time.time() - self.max_age),
+        )
+        return {
+            fingerprint: (zlib.decompress(content), json.loads(renames))
+            for fingerprint, content, renames in rows
+        }
+
+    def set_pages(self, event_id, editable, added, reused):
+        """Store new watermarked pages and keep the reused ones."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO watermarked_pages VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        event_id,
+                        editable,
+                        fingerprint,
+                        zlib.compress(content),
+                        json.dumps(renames),
+                        now,
+                    )
+                    for fingerprint, (content, renames) in added.items()
+                ),
+            )
+            conn.executemany(
+                "UPDATE watermarked_pages SET created = ? "
+                "WHERE event = ? AND editable = ? AND fingerprint = ?",
+                ((now, event_id, editable, fingerprint) for fingerprint in reused),
+            )
+
+    def purge(self, event_id=None):
+        """Remove all entries, or only those of a single event."""
+        if not self.enabled:
+            return 0
+        with self._connect() as conn:
+            if event_id is None:
+                conn.execute("DELETE FROM watermarked_pages")
+                cursor = conn.execute("DELETE FROM watermarked_uploads")
+            else:
+                conn.execute(
+                    "DELETE FROM watermarked_pages WHERE event = ?", (event_id,)
+                )
+                cursor = conn.execute(
+                    "DELETE FROM watermarked_uploads WHERE event = ?", (event_id,)
+                )
+        return cursor.rowcount
+
+    def prune(self):
+        """Remove expired entries and the oldest ones exceeding the limit."""
+        if not self.enabled:
+            return 0
+        with self._connect() as conn:
+            expired = conn.execute(
+                "DELETE FROM watermarked_uploads WHERE created <= ?",
+                (time.time() - self.max_age,),
+            ).rowcount
+            excess = conn.execute(
+                "DELETE FROM watermarked_uploads WHERE rowid IN ("
+                "SELECT rowid FROM watermarked_uploads ORDER BY created DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            conn.execute(
+                "DELETE FROM watermarked_pages WHERE created <= ?",
+                (time.time() - self.max_age,),
+            )
+            conn.execute(
+                "DELETE FROM watermarked_pages WHERE rowid IN ("
+                "SELECT rowid FROM watermarked_pages ORDER BY created DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_pages,),
+            )
+        return expired + excess
+
+
+watermark_cache = WatermarkCache()
+
+
+def register_watermark_cache_cli(app):
+    @app.cli.group("watermark-cache")
+    def cli():
+        """Manage the cache of watermarked files."""
+
+    @cli.command()
+    @click.argument("event", required=False)
+    @click.option("--all", "purge_all", is_flag=True, help="Purge all events")
+    def purge(event, purge_all):
+        """Remove the cached files of an event."""
+        if not event and not purge_all:
+            raise click.UsageError("Specify an event or --all")
+        count = watermark_cache.purge(None if purge_all else event)
+        click.echo("Removed {} cached file(s)".format(count))
+
+    @cli.command()
+    def prune():
+        """Remove expired cache entries."""
+        click.echo("Removed {} cached file(s)".format(watermark_cache.prune()))
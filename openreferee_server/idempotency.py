@@ -0,0 +1,310 @@
+"""Suppression of duplicate webhooks.
+
+Indico retries webhooks which time out, so a retry may arrive while the
+first request is still being processed.  Requests are keyed by the event,
+the editable they concern and a hash of their payload; a duplicate waits
+for the original request and gets the same response, and responses of
+completed requests are replayed for ``IDEMPOTENCY_WINDOW`` seconds.
+
+Keys are stored in the database so this also works across processes;
+requests handled by the same process are collapsed without touching it.
+The Flask views use the `idempotent` decorator and the ASGI app uses
+`process_idempotent`, so duplicates are collapsed across both modes.
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, current_app, request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import Conflict
+
+from .cache import TTLCache
+from .db import db
+from .models import IdempotencyKey
+
+
+# key -> (status, content type, body) of completed requests
+response_cache = TTLCache()
+# key -> threading.Event set once the request is done
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# key -> asyncio.Event set once the request handled by the ASGI app is done;
+# only used from the thread running the event loop
+_async_in_flight = {}
+# runs the database queries of `process_idempotent`, created when first needed
+_executor = None
+_executor_lock = threading.Lock()
+_writes = 0
+
+
+def get_request_key(event, contrib_id, editable_type, revision_id, body):
+    data = "\0".join(
+        str(x) for x in (event.identifier, contrib_id, editable_type, revision_id)
+    )
+    digest = hashlib.sha256(data.encode())
+    digest.update(b"\0")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _replay(stored):
+    status, content_type, body = stored
+    response = Response(body, status=status, content_type=content_type)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _claim(key, event):
+    """Store a pending key in the database.
+
+    :return: `None` if the key was claimed, otherwise the stored response
+             or the pending `IdempotencyKey` of another process
+    """
+    global _writes
+    config = current_app.config
+    now = datetime.utcnow()
+    db.session.add(IdempotencyKey(key=key, event_identifier=event.identifier))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    else:
+        _writes += 1
+        if _writes % 100 == 0:
+            prune_idempotency_keys()
+        return None
+
+    row = IdempotencyKey.query.get(key)
+    if row is None:
+        # not a duplicate key (e.g. the event was removed meanwhile), so the
+        # request is processed without being tracked
+        return None
+    window = timedelta(seconds=config["IDEMPOTENCY_WINDOW"])
+    lease = timedelta(seconds=config["IDEMPOTENCY_LEASE"])
+    if row.status_code is not None and row.created_dt > now - window:
+        return row.status_code, row.content_type, row.body
+    if row.status_code is None and row.created_dt > now - lease:
+        return row
+    # an expired response, or a request whose process most likely died
+    row.created_dt = now
+    row.status_code = row.content_type = row.body = None
+    db.session.commit()
+    return None
+
+
+def _wait_for_other_process(key, deadline):
+    """Wait for another process handling the same request.
+
+    :return: the stored response, or `None` if the request failed
+    """
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        db.session.rollback()
+        row = IdempotencyKey.query.get(key)
+        if row is None:
+            return None
+        if row.status_code is not None:
+            return row.status_code, row.content_type, row.body
+    raise Conflict("The same request is still being processed")
+
+
+def _claim_or_wait(key, event, deadline):
+    """Claim a key, waiting for another process which claimed it.
+
+    :return: `None` if the key was claimed, otherwise the stored response
+    """
+    claimed = _claim(key, event)
+    while isinstance(claimed, IdempotencyKey):
+        claimed = _wait_for_other_process(key, deadline)
+        if claimed is None:
+            claimed = _claim(key, event)
+    return claimed
+
+
+def _release(key, stored):
+    if stored is None:
+        IdempotencyKey.query.filter_by(key=key).delete()
+    else:
+        status, content_type, body = stored
+        IdempotencyKey.query.filter_by(key=key).update(
+            {
+                "status_code": status,
+                "content_type": content_type,
+                "body": body,
+                "created_dt": datetime.utcnow(),
+            }
+        )
+        response_cache.set(key, stored)
+    db.session.commit()
+
+
+def idempotent(fn):
+    """Collapse duplicate requests for a webhook taking an event.
+
+    Only successful responses are stored; if the request fails, a retry is
+    processed normally.
+    """
+
+    @wraps(fn)
+    def wrapper(event, **kwargs):
+        if not current_app.config["IDEMPOTENCY_WINDOW"]:
+            return fn(event=event, **kwargs)
+        key = get_request_key(
+            event,
+            kwargs.get("contrib_id"),
+            kwargs.get("editable_type"),
+            kwargs.get("revision_id"),
+            request.get_data(),
+        )
+        deadline = time.monotonic() + current_app.config["IDEMPOTENCY_WAIT"]
+        while True:
+            stored = response_cache.get(key)
+            if stored is not None:
+                return _replay(stored)
+            with _in_flight_lock:
+                done = _in_flight.get(key)
+                if done is None:
+                    done = _in_flight[key] = threading.Event()
+                    break
+            # wait for the original request; if it failed, process this one
+            if not done.wait(deadline - time.monotonic()):
+                raise Conflict("The same request is still being processed")
+        try:
+            return _process(fn, key, event, kwargs, deadline)
+        finally:
+            with _in_flight_lock:
+                del _in_flight[key]
+            done.set()
+
+    return wrapper
+
+
+def _process(fn, key, event, kwargs, deadline):
+    claimed = _claim_or_wait(key, event, deadline)
+    if claimed is not None:
+        response_cache.set(key, claimed)
+        return _replay(claimed)
+    try:
+        response = current_app.make_response(fn(event=event, **kwargs))
+    except Exception:
+        db.session.rollback()
+        _release(key, None)
+        raise
+    stored = None
+    if response.status_code < 300 and not response.is_streamed:
+        stored = (
+            response.status_code,
+            response.content_type,
+            response.get_data(as_text=True),
+        )
+    _release(key, stored)
+    return response
+
+
+def _run_in_context(app, fn, *args):
+    # runs in an executor thread, which needs its own context and session
+    with app.app_context():
+        try:
+            return fn(*args)
+        finally:
+            db.session.remove()
+
+
+def _get_executor(max_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers, thread_name_prefix="idempotency"
+            )
+        return _executor
+
+
+async def process_idempotent(event, kwargs, body, fn):
+    """Collapse duplicate requests handled by the ASGI app.
+
+    This works like `idempotent`, with `fn` being a coroutine function
+    returning a ``(status, content type, body)`` tuple.  Duplicates wait
+    for the original request on the event loop, so a burst of retries does
+    not tie up any threads.  Claiming and releasing the key, which may wait
+    for another process, run in a dedicated executor with
+    ``IDEMPOTENCY_DB_THREADS`` threads, so they never hold up the threads
+    of the default executor used e.g. to authenticate requests.
+
+    :param kwargs: the arguments identifying the editable and revision
+    :param body: the raw request body
+    :return: the ``(status, content type, body)`` tuple of the response and
+             whether it was replayed
+    """
+    app = current_app._get_current_object()
+    loop = asyncio.get_event_loop()
+    executor = _get_executor(app.config["IDEMPOTENCY_DB_THREADS"])
+    key = get_request_key(
+        event,
+        kwargs.get("contrib_id"),
+        kwargs.get("editable_type"),
+        kwargs.get("revision_id"),
+        body,
+    )
+    deadline = time.monotonic() + app.config["IDEMPOTENCY_WAIT"]
+    while True:
+        stored = response_cache.get(key)
+        if stored is not None:
+            return stored, True
+        done = _async_in_flight.get(key)
+        if done is None:
+            done = _async_in_flight[key] = asyncio.Event()
+            break
+        # wait for the original request; if it failed, process this one
+        try:
+            await asyncio.wait_for(done.wait(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            raise Conflict("The same request is still being processed")
+    try:
+        claimed = await loop.run_in_executor(
+            executor, _run_in_context, app, _claim_or_wait, key, event, deadline
+        )
+        if claimed is not None:
+            response_cache.set(key, claimed)
+            return claimed, True
+        try:
+            response = await fn()
+        except Exception:
+            await loop.run_in_executor(
+                executor, _run_in_context, app, _release, key, None
+            )
+            raise
+        stored = response if response[0] < 300 else None
+        await loop.run_in_executor(
+            executor, _run_in_context, app, _release, key, stored
+        )
+        return response, False
+    finally:
+        del _async_in_flight[key]
+        done.set()
+
+
+def prune_idempotency_keys():
+    """Remove stored responses older than the idempotency window."""
+    config = current_app.config
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=max(config["IDEMPOTENCY_WINDOW"], config["IDEMPOTENCY_LEASE"])
+    )
+    count = IdempotencyKey.query.filter(IdempotencyKey.created_dt < cutoff).delete()
+    db.session.commit()
+    return count
+
+
+def forget_event_requests(event):
+    """Drop the in-process responses after an event has been removed.
+
+    The cache is not keyed by event, so it is cleared entirely; this is
+    fine since events are rarely removed.
+    """
+    response_cache.clear()
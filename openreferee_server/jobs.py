@@ -0,0 +1,328 @@
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+
+from .db import db
+from .metrics import CallbackMetric, indico_calls, serve_metrics
+from .models import Job, JobState, ProvisioningState
+from .operations import get_requests_session, process_editable_files, provision_event
+
+
+class RetryJob(Exception):
+    """Raised by a job handler to have the job retried later."""
+
+
+def watermark_revision_files(
+    event, files, endpoints, contrib_id=None, editable_type=None
+):
+    session = get_requests_session(event)
+    with indico_calls.time("revision_details"):
+        response = session.get(endpoints["revisions"]["details"])
+    if response.status_code != 200:
+        raise RetryJob("Revision has not been committed yet")
+    process_editable_files(session, event, files, endpoints, contrib_id, editable_type)
+
+
+def provision_event_job(event):
+    try:
+        provision_event(event)
+    except Exception as exc:
+        event.provisioning_state = ProvisioningState.failed
+        event.provisioning_error = str(exc)
+        db.session.commit()
+        raise
+    event.provisioning_state = ProvisioningState.done
+    event.provisioning_error = None
+
+
+JOB_HANDLERS = {
+    "provision": provision_event_job,
+    "watermark": watermark_revision_files,
+}
+
+
+def enqueue_job(event, kind, **payload):
+    """Add a job to the queue.
+
+    The job is only picked up by a worker once the current database
+    transaction has been committed.
+    """
+    job = Job(
+        event_identifier=event.identifier,
+        kind=kind,
+        payload=payload,
+        max_attempts=current_app.config["JOB_MAX_ATTEMPTS"],
+    )
+    db.session.add(job)
+    return job
+
+
+def _queue_depth():
+    counts = {(state.name,): 0 for state in JobState}
+    query = db.session.query(Job.state, db.func.count()).group_by(Job.state)
+    for state, count in query:
+        counts[(state.name,)] = count
+    return counts
+
+
+CallbackMetric(
+    "openreferee_jobs", "Number of queued jobs by state", ("state",), _queue_depth
+)
+
+
+def _retry_delay(attempts):
+    config = current_app.config
+    delay = config["JOB_RETRY_DELAY"] * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(delay, config["JOB_RETRY_MAX_DELAY"]))
+
+
+def claim_job():
+    """Claim the next due job and mark it as running.
+
+    Running jobs are leased for ``JOB_LEASE`` seconds so jobs whose worker
+    died are picked up again once the lease expires; while the job runs,
+    its lease is extended by a `JobHeartbeat`.
+
+    The job is only updated if its state and due time are still those it
+    was selected with, so if another worker claimed it meanwhile, the next
+    job is tried instead.  This is needed on SQLite, which cannot lock rows.
+    """
+    now = datetime.utcnow()
+    while True:
+        candidate = (
+            db.session.query(Job.id, Job.state, Job.run_at)
+            .filter(
+                Job.state.in_((JobState.pending, JobState.running)), Job.run_at <= now
+            )
+            .order_by(Job.run_at)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if candidate is None:
+            db.session.rollback()
+            return None
+        claimed = Job.query.filter_by(
+            id=candidate.id, state=candidate.state, run_at=candidate.run_at
+        ).update(
+            {
+                Job.state: JobState.running,
+                Job.attempts: Job.attempts + 1,
+                Job.run_at: now + timedelta(seconds=current_app.config["JOB_LEASE"]),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            return Job.query.get(candidate.id)
+
+
+class JobHeartbeat(threading.Thread):
+    """Extend the lease of a running job until it is done.
+
+    Otherwise a job running for longer than ``JOB_LEASE`` would be claimed
+    again by another worker while it is still running.  The lease is
+    extended every third of ``JOB_LEASE``, as long as the job still holds
+    the lease it was claimed with.
+    """
+
+    def __init__(self, app, job):
+        super().__init__(name="heartbeat-{}".format(job.id), daemon=True)
+        self.app = app
+        self.job_id = job.id
+        self.run_at = job.run_at
+        # set when another worker claimed the job because the lease expired
+        self.lost = False
+        self._done = threading.Event()
+
+    def run(self):
+        lease = self.app.config["JOB_LEASE"]
+        with self.app.app_context():
+            try:
+                while not self._done.wait(lease / 3):
+                    try:
+                        self._extend(lease)
+                    except Exception:
+                        db.session.rollback()
+                        self.app.logger.exception(
+                            "Could not extend the lease of job %d", self.job_id
+                        )
+                    if self.lost:
+                        return
+            finally:
+                db.session.remove()
+
+    def _extend(self, lease):
+        run_at = datetime.utcnow() + timedelta(seconds=lease)
+        extended = Job.query.filter_by(
+            id=self.job_id, state=JobState.running, run_at=self.run_at
+        ).update({Job.run_at: run_at}, synchronize_session=False)
+        db.session.commit()
+        if extended:
+            self.run_at = run_at
+        else:
+            self.lost = True
+            self.app.logger.warning("Job %d lost its lease", self.job_id)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _reschedule(job, error):
+    job.last_error = error
+    if job.attempts >= job.max_attempts:
+        job.state = JobState.failed
+        current_app.logger.error("Job %r failed permanently: %s", job, error)
+        return
+    job.state = JobState.pending
+    job.run_at = datetime.utcnow() + _retry_delay(job.attempts)
+    current_app.logger.info("Job %r will be retried at %s: %s", job, job.run_at, error)
+
+
+def run_next_job():
+    """Run the next due job, if any.
+
+    :return: whether a job was run
+    """
+    job = claim_job()
+    if job is None:
+        return False
+    current_app.logger.info("Running job %r (attempt %d)", job, job.attempts)
+    heartbeat = JobHeartbeat(current_app._get_current_object(), job)
+    heartbeat.start()
+    try:
+        JOB_HANDLERS[job.kind](job.event, **job.payload)
+    except RetryJob as exc:
+        error = str(exc)
+    except Exception as exc:
+        current_app.logger.exception("Job %r raised an exception", job)
+        error = repr(exc)
+    else:
+        error = None
+    finally:
+        heartbeat.stop()
+    if heartbeat.lost:
+        # the job belongs to the worker which claimed it again now
+        db.session.rollback()
+        current_app.logger.warning("Job %r was claimed again while running", job)
+    elif error is not None:
+        db.session.rollback()
+        _reschedule(job, error)
+    else:
+        db.session.delete(job)
+        current_app.logger.info("Job %r done", job)
+    db.session.commit()
+    return True
+
+
+def run_worker(app, concurrency, poll_interval, burst=False):
+    """Process jobs using a fixed number of worker threads.
+
+    :param burst: stop once there are no more due jobs
+    """
+    stop = threading.Event()
+
+    def _work():
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    ran = run_next_job()
+                except Exception:
+                    app.logger.exception("Worker loop failed")
+                    ran = False
+                finally:
+                    db.session.remove()
+                if not ran:
+                    if burst:
+                        return
+                    stop.wait(poll_interval)
+
+    threads = [
+        threading.Thread(target=_work, name="worker-{}".format(i), daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        app.logger.info("Waiting for running jobs to finish...")
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def register_job_cli(app):
+    @app.cli.command("worker")
+    @click.option(
+        "--concurrency",
+        "-c",
+        type=int,
+        help="Number of jobs processed in parallel (defaults to JOB_CONCURRENCY)",
+    )
+    @click.option(
+        "--poll-interval", type=float, default=1.0, help="Seconds to wait when idle"
+    )
+    @click.option("--burst", is_flag=True, help="Exit once the queue is empty")
+    @click.option(
+        "--metrics-port", type=int, help="Serve the worker's metrics on this port"
+    )
+    def worker(concurrency, poll_interval, burst, metrics_port):
+        """Run the background job worker."""
+        app = current_app._get_current_object()
+        concurrency = concurrency or app.config["JOB_CONCURRENCY"]
+        if metrics_port:
+            serve_metrics(app, metrics_port)
+        run_worker(app, concurrency, poll_interval, burst)
+
+    @app.cli.group("jobs")
+    def cli():
+        """Manage background jobs."""
+
+    @cli.command("list")
+    @click.option(
+        "--state",
+        type=click.Choice([s.name for s in JobState]),
+        help="Only show jobs in the given state",
+    )
+    def list_jobs(state):
+        """List queued and failed jobs."""
+        query = Job.query.order_by(Job.id)
+        if state:
+            query = query.filter_by(state=JobState[state])
+        for job in query:
+            click.echo(
+                "{}\t{}\t{}\t{}\t{}/{}\t{}\t{}".format(
+                    job.id,
+                    job.event_identifier,
+                    job.kind,
+                    job.state.name,
+                    job.attempts,
+                    job.max_attempts,
+                    job.run_at.isoformat(),
+                    job.last_error or "",
+                )
+            )
+
+    @cli.command()
+    @click.argument("job_ids", type=int, nargs=-1)
+    @click.option("--all", "all_failed", is_flag=True, help="Requeue all failed jobs")
+    def requeue(job_ids, all_failed):
+        """Requeue failed jobs."""
+        if not job_ids and not all_failed:
+            raise click.UsageError("Specify job ids or --all")
+        query = Job.query.filter_by(state=JobState.failed)
+        if not all_failed:
+            query = query.filter(Job.id.in_(job_ids))
+        count = 0
+        for job in query:
+            job.state = JobState.pending
+            job.attempts = 0
+            job.run_at = datetime.utcnow()
+            count += 1
+        db.session.commit()
+        click.echo("Requeued {} job(s)".format(count))
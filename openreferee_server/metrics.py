@@ -0,0 +1,214 @@
+"""Minimal Prometheus-style metrics.
+
+Metrics are kept in memory per process and rendered in the Prometheus text
+exposition format.  Updating a metric only takes a lock and a few
+arithmetic operations, so it is cheap enough for the hot paths.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                k,
+                str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for k, v in pairs
+        )
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _header(self):
+        return [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, k), _format_value(v)
+            )
+            for k, v in values
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # labels -> [bucket counts (not cumulative)..., sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * len(self.buckets) + [0]
+            data[index] += 1
+            data[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self._header()
+        for labels, data in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(
+                            self.labelnames, labels, [("le", _format_value(bound))]
+                        ),
+                        cumulative,
+                    )
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append("{}_sum{} {}".format(self.name, label_str, data[-1]))
+            lines.append("{}_count{} {}".format(self.name, label_str, cumulative))
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """A metric whose values are computed by a callback when rendered.
+
+    This is used to export values which are already tracked elsewhere, such
+    as cache statistics.  The callback returns a dict mapping label value
+    tuples to values.
+    """
+
+    def __init__(self, name, documentation, labelnames, callback, type="gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def render(self):
+        return self._header() + [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, k), _format_value(v)
+            )
+            for k, v in sorted(self.callback().items())
+        ]
+
+
+registry = []
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(app, port, host=""):
+    """Serve the metrics of this process in a background thread.
+
+    This is meant for processes which do not serve the API, such as the
+    job worker.
+    """
+
+    def _app(environ, start_response):
+        with app.app_context():
+            body = render_metrics().encode()
+        start_response(
+            "200 OK",
+            [("Content-Type", CONTENT_TYPE), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+    server = make_server(host, port, _app, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+http_requests = Histogram(
+    "openreferee_http_request_duration_seconds",
+    "Time spent handling requests to the API",
+    ("endpoint", "status"),
+)
+indico_calls = Histogram(
+    "openreferee_indico_request_duration_seconds",
+    "Time spent waiting for requests made to Indico",
+    ("kind",),
+)
+watermark_duration = Histogram(
+    "openreferee_watermark_duration_seconds",
+    "Time spent watermarking a PDF file, excluding download and upload",
+)
+watermark_pages = Histogram(
+    "openreferee_watermark_pages",
+    "Number of pages of watermarked PDF files",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+watermark_page_merges = Counter(
+    "openreferee_watermark_page_merges_total",
+    "Pages the watermark was merged into, or whose watermarked content was reused",
+    ("result",),
+)
+watermark_cache_lookups = Counter(
+    "openreferee_watermark_cache_lookups_total",
+    "Lookups in the cache of watermarked files",
+    ("result",),
+)
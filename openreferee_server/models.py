@@ -1,6 +1,15 @@
+from datetime import datetime
+from enum import Enum
+
 from .db import db
 
 
+class ProvisioningState(Enum):
+    pending = "pending"
+    done = "done"
+    failed = "failed"
+
+
 class Event(db.Model):
     __tablename__ = "events"
     identifier = db.Column(db.String, primary_key=True)
@@ -8,3 +17,99 @@ class Event(db.Model):
     url = db.Column(db.String, nullable=False)
     token = db.Column(db.String, nullable=False)
     endpoints = db.Column(db.JSON, nullable=False)
+    provisioning_state = db.Column(
+        db.Enum(ProvisioningState, native_enum=False),
+        nullable=False,
+        default=ProvisioningState.pending,
+    )
+    provisioning_error = db.Column(db.String)
+
+
+class EventRecord:
+    """The data of an `Event` needed to handle webhooks.
+
+    Unlike `Event` it is not bound to a database session, so it can be
+    built from cached data.
+    """
+
+    __slots__ = ("identifier", "url", "token", "endpoints")
+
+    def __init__(self, identifier, url, token, endpoints):
+        self.identifier = identifier
+        self.url = url
+        self.token = token
+        self.endpoints = endpoints
+
+    def __repr__(self):
+        return "<EventRecord({})>".format(self.identifier)
+
+
+class JobState(Enum):
+    pending = "pending"
+    running = "running"
+    failed = "failed"
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    event_identifier = db.Column(
+        db.String,
+        db.ForeignKey("events.identifier", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    kind = db.Column(db.String, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    state = db.Column(
+        db.Enum(JobState, native_enum=False),
+        nullable=False,
+        default=JobState.pending,
+    )
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # when a pending job becomes due, or when the lease of a running job expires
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    created_dt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String)
+
+    event = db.relationship(
+        "Event",
+        backref=db.backref("jobs", cascade="all, delete-orphan", passive_deletes=True),
+    )
+
+    def __repr__(self):
+        return "<Job({}, {}, {}, {})>".format(
+            self.id, self.kind, self.event_identifier, self.state.name
+        )
+
+
+class IdempotencyKey(db.Model):
+    """A webhook request which has been processed or is being processed."""
+
+    __tablename__ = "idempotency_keys"
+    key = db.Column(db.String, primary_key=True)
+    event_identifier = db.Column(
+        db.String,
+        db.ForeignKey("events.identifier", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    # when the request started, or when its response was stored
+    created_dt = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+    # the response is only set once the request has been processed
+    status_code = db.Column(db.Integer)
+    content_type = db.Column(db.String)
+    body = db.Column(db.Text)
+
+    event = db.relationship(
+        "Event",
+        backref=db.backref(
+            "idempotency_keys", cascade="all, delete-orphan", passive_deletes=True
+        ),
+    )
+
+    def __repr__(self):
+        return "<IdempotencyKey({}, {})>".format(self.key, self.event_identifier)
@@ -1,153 +1,763 @@
+import hashlib
 import os
+import queue
+import threading
+import time
 from collections import defaultdict
-from io import BytesIO
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from uuid import uuid4
 
 import requests
 from flask import current_app
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .actions import registry as action_registry
+from .cache import TTLCache
+from .dedup import watermark_cache
+from .defaults import DEFAULT_EDITABLES, DEFAULT_FILE_TYPES, DEFAULT_TAGS
+from .metrics import (
+    CallbackMetric,
+    indico_calls,
+    watermark_cache_lookups,
+    watermark_duration,
+    watermark_page_merges,
+    watermark_pages,
+)
+from .watermark import (
+    WatermarkedPages,
+    discard_process_pool,
+    get_process_pool,
+    merge_watermark,
+    merge_watermark_parallel,
+    watermark_template,
+    write_watermarked,
+)
 
-from .defaults import (
-    CUSTOM_ACTIONS,
-    DEFAULT_EDITABLES,
-    DEFAULT_FILE_TYPES,
-    DEFAULT_TAGS,
+
+# event identifier -> {tag code: tag}, configured in `create_app`
+tag_cache = TTLCache()
+# event identifier -> (token digest, url, endpoints), configured in `create_app`
+event_cache = TTLCache()
+_caches = {"events": event_cache, "tags": tag_cache}
+
+CallbackMetric(
+    "openreferee_cache_requests_total",
+    "Lookups in the in-process caches",
+    ("cache", "result"),
+    lambda: {
+        (name, result): cache.stats()[result]
+        for name, cache in _caches.items()
+        for result in ("hits", "misses")
+    },
+    type="counter",
+)
+CallbackMetric(
+    "openreferee_cache_entries",
+    "Number of entries in the in-process caches",
+    ("cache",),
+    lambda: {(name,): len(cache) for name, cache in _caches.items()},
 )
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTP adapter applying a default timeout to all requests."""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
 def setup_requests_session(token):
+    config = current_app.config
     session = requests.Session()
     session.headers = {"Authorization": "Bearer {}".format(token)}
     if current_app.debug:
         session.verify = False
+    # only idempotent requests are retried, and only on connection errors
+    # or when Indico is temporarily unavailable
+    retry = Retry(
+        total=config["HTTP_RETRIES"],
+        backoff_factor=config["HTTP_RETRY_BACKOFF"],
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config["HTTP_POOL_SIZE"],
+        max_retries=retry,
+        timeout=(config["HTTP_CONNECT_TIMEOUT"], config["HTTP_READ_TIMEOUT"]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     return session
 
 
-def get_event_tags(session, event):
+# event identifier -> ((url, token), session)
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_requests_session(event):
+    """Get the shared session used to talk to the Indico instance of an event.
+
+    Sessions are reused across requests to keep connections to Indico
+    alive; a new one is created if the token of the event changed.
+    """
+    key = (event.url, event.token)
+    with _sessions_lock:
+        entry = _sessions.get(event.identifier)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        session = setup_requests_session(event.token)
+        _sessions[event.identifier] = (key, session)
+        return session
+
+
+def close_requests_session(event):
+    with _sessions_lock:
+        entry = _sessions.pop(event.identifier, None)
+    if entry is not None:
+        entry[1].close()
+
+
+class ConcurrentOperationError(Exception):
+    """Raised when some of the operations run concurrently failed.
+
+    :param errors: a dict mapping the keys of the failed operations to
+                   their exceptions
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "Processing failed for {}".format(
+                ", ".join("{} ({!r})".format(k, v) for k, v in errors.items())
+            )
+        )
+
+
+def run_concurrently(operations, max_workers, name):
+    """Run operations in a bounded thread pool.
+
+    The operations run within the current app context.  All of them are
+    run to completion even if some fail.
+
+    :param operations: a dict mapping keys to callables
+    :return: a dict mapping the keys to the results of the callables
+    :raise ConcurrentOperationError: if any of the operations failed
+    """
+    app = current_app._get_current_object()
+
+    def _run(fn):
+        with app.app_context():
+            return fn()
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix=name) as pool:
+        futures = {key: pool.submit(_run, fn) for key, fn in operations.items()}
+        wait(futures.values())
+    errors = {key: f.exception() for key, f in futures.items() if f.exception()}
+    if errors:
+        raise ConcurrentOperationError(errors)
+    return {key: f.result() for key, f in futures.items()}
+
+
+def fetch_event_tags(session, event):
     tag_endpoint = event.endpoints["tags"]["list"]
 
     current_app.logger.info("Fetching available tags...")
-    response = session.get(tag_endpoint)
+    with indico_calls.time("tags_list"):
+        response = session.get(tag_endpoint)
     response.raise_for_status()
-    return {t["code"]: t for t in response.json()}
+    return tags_by_code(response.json())
+
+
+def tags_by_code(tags):
+    return {t["code"]: t for t in tags}
+
+
+def get_event_tags(session, event, require=()):
+    """Get the tag catalog of an event, preferably from the cache.
+
+    The catalog is only fetched from Indico on a cache miss or if any of
+    the tag codes in `require` is missing from the cached catalog.
+    """
+    available_tags = tag_cache.get(event.identifier)
+    if available_tags is None or any(c not in available_tags for c in require):
+        available_tags = fetch_event_tags(session, event)
+        tag_cache.set(event.identifier, available_tags)
+    return available_tags
 
 
 def setup_event_tags(session, event):
     tag_endpoint = event.endpoints["tags"]["create"]
-    available_tags = get_event_tags(session, event)
+    available_tags = fetch_event_tags(session, event)
 
     current_app.logger.info("Adding missing tags...")
+    added = False
     for code, data in DEFAULT_TAGS.items():
         if code in available_tags:
             # tag already available in Indico event
             continue
-        response = session.post(tag_endpoint, json=dict(data, code=code))
+        with indico_calls.time("tag_create"):
+            response = session.post(tag_endpoint, json=dict(data, code=code))
         response.raise_for_status()
+        added = True
         current_app.logger.info("Added '{}'...".format(code))
 
+    if added:
+        available_tags = fetch_event_tags(session, event)
+    tag_cache.set(event.identifier, available_tags)
+
+
+def _delete_resource(session, kind, url, description):
+    with indico_calls.time(kind):
+        response = session.delete(url)
+    if response.status_code == 404:
+        current_app.logger.info("{} was already deleted".format(description))
+        return
+    response.raise_for_status()
+    current_app.logger.info("Deleted {}".format(description))
+
 
-def cleanup_event_tags(session, event):
-    available_tags = get_event_tags(session, event)
+def get_tag_deletions(session, event):
+    """Get the operations deleting the unused tags of an event."""
+    # always fetch fresh data since we need the current usage information
+    available_tags = fetch_event_tags(session, event)
+    deletions = {}
     for tag_name in DEFAULT_TAGS:
         if tag_name not in available_tags:
             continue
         tag = available_tags[tag_name]
         if not tag["is_used_in_revision"]:
             # delete tag, as it's unused
-            response = session.delete(tag["url"])
-            response.raise_for_status()
-            current_app.logger.info("Deleted tag '{}'".format(tag["title"]))
+            deletions["tag:" + tag_name] = partial(
+                _delete_resource,
+                session,
+                "tag_delete",
+                tag["url"],
+                "tag '{}'".format(tag["title"]),
+            )
+    return deletions
 
 
 def get_file_types(session, event, editable):
     endpoint = event.endpoints["file_types"][editable]["list"]
     current_app.logger.info("Fetching available file types ({})...".format(editable))
-    response = session.get(endpoint)
+    with indico_calls.time("file_types_list"):
+        response = session.get(endpoint)
     response.raise_for_status()
     return {t["name"]: t for t in response.json()}
 
 
-def setup_file_types(session, event):
-    for editable in DEFAULT_EDITABLES:
-        available_file_types = get_file_types(session, event, editable)
-        for type_data in DEFAULT_FILE_TYPES[editable]:
-            if type_data["name"] in available_file_types:
-                continue
-            endpoint = event.endpoints["file_types"][editable]["create"]
+def setup_editable_types(session, event):
+    with indico_calls.time("editable_types"):
+        response = session.post(
+            event.endpoints["editable_types"],
+            json={"editable_types": list(DEFAULT_EDITABLES)},
+        )
+    response.raise_for_status()
+
+
+def setup_file_types(session, event, editable):
+    available_file_types = get_file_types(session, event, editable)
+    for type_data in DEFAULT_FILE_TYPES[editable]:
+        if type_data["name"] in available_file_types:
+            continue
+        endpoint = event.endpoints["file_types"][editable]["create"]
+        with indico_calls.time("file_type_create"):
             response = session.post(endpoint, json=type_data)
-            response.raise_for_status()
-            current_app.logger.info(
-                "Added '{}' to '{}'".format(type_data["name"], type_data)
+        response.raise_for_status()
+        current_app.logger.info(
+            "Added '{}' to '{}'".format(type_data["name"], type_data)
+        )
+
+
+def get_file_type_deletions(session, event, editable):
+    """Get the operations deleting the unused file types of an editable type."""
+    available_types = get_file_types(session, event, editable)
+    deletions = {}
+    for ftype in DEFAULT_FILE_TYPES[editable]:
+        server_type = available_types.get(ftype["name"])
+        if server_type is None:
+            # already deleted in Indico
+            continue
+        if not server_type["is_used_in_condition"] and not server_type["is_used"]:
+            deletions["file_type:{}:{}".format(editable, ftype["name"])] = partial(
+                _delete_resource,
+                session,
+                "file_type_delete",
+                server_type["url"],
+                "file type '{}'".format(server_type["name"]),
             )
+    return deletions
 
 
-def cleanup_file_types(session, event):
+def provision_event(event):
+    """Create the tags, editable types and file types an event needs.
+
+    The independent parts are provisioned concurrently.  Provisioning an
+    event again only creates what is still missing.
+    """
+    session = get_requests_session(event)
+    operations = {
+        "tags": partial(setup_event_tags, session, event),
+        "editable_types": partial(setup_editable_types, session, event),
+    }
     for editable in DEFAULT_EDITABLES:
-        available_types = get_file_types(session, event, editable)
-        for ftype in DEFAULT_FILE_TYPES[editable]:
-            server_type = available_types[ftype["name"]]
-            if not server_type["is_used_in_condition"] and not server_type["is_used"]:
-                response = session.delete(server_type["url"])
-                response.raise_for_status()
-                current_app.logger.info(
-                    "Deleted file type '{}'".format(server_type["name"])
-                )
+        operations["file_types:" + editable] = partial(
+            setup_file_types, session, event, editable
+        )
+    run_concurrently(
+        operations, current_app.config["PROVISIONING_CONCURRENCY"], "provision"
+    )
 
 
 def cleanup_event(event):
-    session = setup_requests_session(event.token)
-    cleanup_event_tags(session, event)
-    cleanup_file_types(session, event)
-
+    """Delete the unused tags and file types the service created.
+
+    The tags and file types are fetched, and then deleted, concurrently.
+    Ones which no longer exist are skipped, so cleaning up an event again
+    after a failure is safe.
+    """
+    session = get_requests_session(event)
+    concurrency = current_app.config["PROVISIONING_CONCURRENCY"]
+    lookups = {"tags": partial(get_tag_deletions, session, event)}
+    for editable in DEFAULT_EDITABLES:
+        lookups["file_types:" + editable] = partial(
+            get_file_type_deletions, session, event, editable
+        )
+    deletions = {}
+    for operations in run_concurrently(lookups, concurrency, "cleanup").values():
+        deletions.update(operations)
+    run_concurrently(deletions, concurrency, "cleanup")
+
+
+# functions closing the clients of an event once it has been removed
+client_closers = [close_requests_session]
+
+
+def invalidate_event_caches(event):
+    event_cache.pop(event.identifier)
+    tag_cache.pop(event.identifier)
+    for close_client in client_closers:
+        close_client(event)
+    watermark_cache.purge(event.identifier)
+
+
+class FileProcessingError(ConcurrentOperationError):
+    """Raised when some files of a revision could not be processed.
+
+    :param errors: a dict mapping the failed filenames to their exceptions
+    """
+
+
+def process_editable_files(
+    session, event, files, endpoints, contrib_id=None, editable_type=None
+):
+    available_tags = get_event_tags(session, event, require={"WATERMARKED"})
+
+    # files are processed concurrently, but only replace the revision once
+    # all of them succeeded to never leave it half-processed
+    cache_updates = []
+    try:
+        uploads = run_concurrently(
+            {
+                i: partial(
+                    process_pdf,
+                    event,
+                    file,
+                    session,
+                    endpoints["file_upload"],
+                    contrib_id,
+                    editable_type,
+                    cache_updates,
+                )
+                for i, file in enumerate(files)
+                if os.path.splitext(file["filename"])[1] == ".pdf"
+            },
+            current_app.config["FILE_PROCESSING_CONCURRENCY"],
+            "process-file",
+        )
+    except ConcurrentOperationError as exc:
+        raise FileProcessingError(
+            {files[i]["filename"]: error for i, error in exc.errors.items()}
+        ) from None
 
-def process_editable_files(session, event, files, endpoints):
-    available_tags = get_event_tags(session, event)
     uploaded = defaultdict(list)
-    for file in files:
-        if os.path.splitext(file["filename"])[1] != ".pdf":
-            uploaded[file["file_type"]].append(file["uuid"])
-            continue
-        upload = process_pdf(file, session, endpoints["file_upload"])
-        uploaded[file["file_type"]].append(upload["uuid"])
-
-    response = session.post(
-        endpoints["revisions"]["replace"],
-        json={
-            "files": uploaded,
-            "state": "ready_for_review",
-            "comment": "PDF has been watermarked.",
-            "tags": [available_tags["WATERMARKED"]["id"]],
-        },
-    )
+    for i, file in enumerate(files):
+        uuid = uploads[i]["uuid"] if i in uploads else file["uuid"]
+        uploaded[file["file_type"]].append(uuid)
+
+    with indico_calls.time("revision_replace"):
+        response = session.post(
+            endpoints["revisions"]["replace"],
+            json={
+                "files": uploaded,
+                "state": "ready_for_review",
+                "comment": "PDF has been watermarked.",
+                "tags": [available_tags["WATERMARKED"]["id"]],
+            },
+        )
     response.raise_for_status()
+    # uploads not attached to the revision must not be reused
+    for update in cache_updates:
+        update()
+
+
+class _MultipartBody:
+    def __init__(self, field, filename, content_type):
+        self.boundary = uuid4().hex
+        filename = filename.replace('"', "%22")
+        self._head = (
+            "--{}\r\n"
+            'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+            "Content-Type: {}\r\n\r\n".format(
+                self.boundary, field, filename, content_type
+            )
+        ).encode()
+        self._tail = "\r\n--{}--\r\n".format(self.boundary).encode()
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary={}".format(self.boundary)
 
+    def __iter__(self):
+        yield self._head
+        yield from self._iter_content()
+        yield self._tail
+
+
+class MultipartFileBody(_MultipartBody):
+    """A ``multipart/form-data`` request body streaming a single file.
+
+    The file is read in chunks while the request is sent, so it never has
+    to be held in memory in its entirety.
+    """
 
-def process_pdf(file, session, upload_endpoint):
-    pdf_writer = PdfFileWriter()
-    resp = session.get(file["signed_download_url"])
-    resp.raise_for_status()
-    pdf_reader = PdfFileReader(BytesIO(resp.content))
-    with (Path(__file__).parent / "watermark.pdf").open("rb") as watermark_file:
-        watermark_pdf = PdfFileReader(watermark_file)
-        watermark_page = watermark_pdf.getPage(0)
-        for i in range(pdf_reader.numPages):
-            page = pdf_reader.getPage(i)
-            page.mergePage(watermark_page)
-            pdf_writer.addPage(page)
-        with BytesIO() as buf:
-            pdf_writer.write(buf)
-            buf.seek(0)
-            r = session.post(
+    def __init__(self, field, filename, fileobj, content_type, chunk_size):
+        super().__init__(field, filename, content_type)
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        fileobj.seek(0, os.SEEK_END)
+        self._size = fileobj.tell()
+
+    def __len__(self):
+        return len(self._head) + self._size + len(self._tail)
+
+    def _iter_content(self):
+        self.fileobj.seek(0)
+        return iter(lambda: self.fileobj.read(self.chunk_size), b"")
+
+
+class MultipartStreamBody(_MultipartBody):
+    """A ``multipart/form-data`` request body with a file of unknown size.
+
+    The body has no length, so it is sent with chunked transfer encoding
+    while the chunks are being produced.
+    """
+
+    def __init__(self, field, filename, chunks, content_type):
+        super().__init__(field, filename, content_type)
+        self.chunks = chunks
+
+    def _iter_content(self):
+        return iter(self.chunks)
+
+
+class PipeClosed(Exception):
+    """Raised when writing to a `Pipe` whose reader has gone away."""
+
+
+class Pipe:
+    """A file-like object passing what is written to it to another thread.
+
+    Written data is handed over in chunks through a bounded queue, so a
+    writer producing data faster than it is read blocks instead of
+    buffering everything.  Iterating over the pipe yields the chunks until
+    the writer calls `finish`; an exception passed to it is re-raised in
+    the reader.
+    """
+
+    _done = object()
+
+    def __init__(self, chunk_size, max_chunks):
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(max_chunks)
+        self._buf = bytearray()
+        self._pos = 0
+        self._closed = threading.Event()
+
+    def tell(self):
+        return self._pos
+
+    def write(self, data):
+        self._buf += data
+        self._pos += len(data)
+        if len(self._buf) >= self.chunk_size:
+            self._put(bytes(self._buf))
+            self._buf.clear()
+        return len(data)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise PipeClosed
+
+    def finish(self, exc=None):
+        """Signal the reader that writing is done or failed."""
+        if exc is None and self._buf:
+            self._put(bytes(self._buf))
+            self._buf.clear()
+        self._put(exc or self._done)
+
+    def close(self):
+        """Stop reading; the writer gets a `PipeClosed` exception."""
+        self._closed.set()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._done:
+                return
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def download_file(session, url):
+    """Download a file into a spooled temporary file.
+
+    Files larger than ``PDF_SPOOL_MAX_SIZE`` are kept on disk instead of
+    in memory.
+
+    :return: a ``(file, sha256)`` tuple
+    """
+    config = current_app.config
+    buf = SpooledTemporaryFile(max_size=config["PDF_SPOOL_MAX_SIZE"])
+    digest = hashlib.sha256()
+    with indico_calls.time("file_download"), session.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(config["STREAM_CHUNK_SIZE"]):
+            digest.update(chunk)
+            buf.write(chunk)
+    buf.seek(0)
+    return buf, digest.hexdigest()
+
+
+def upload_file(session, upload_endpoint, filename, fileobj, content_type):
+    body = MultipartFileBody(
+        "file",
+        filename,
+        fileobj,
+        content_type or "application/octet-stream",
+        current_app.config["STREAM_CHUNK_SIZE"],
+    )
+    return _post_upload(session, upload_endpoint, body)
+
+
+def upload_pipelined(session, upload_endpoint, filename, write, content_type):
+    """Upload a file while it is being written.
+
+    `write` is called with a file-like object in a separate thread, so the
+    CPU work of producing the file overlaps with sending what has already
+    been written.  At most ``PDF_PIPELINE_BUFFER_SIZE`` bytes are buffered
+    in between.
+
+    :return: a ``(upload, written)`` tuple, where `written` is the
+             `time.perf_counter` value when the document was fully written
+    """
+    config = current_app.config
+    chunk_size = config["STREAM_CHUNK_SIZE"]
+    pipe = Pipe(chunk_size, max(1, config["PDF_PIPELINE_BUFFER_SIZE"] // chunk_size))
+    written = []
+
+    def _write():
+        try:
+            write(pipe)
+        except PipeClosed:
+            return
+        except Exception as exc:
+            pipe.finish(exc)
+            return
+        written.append(time.perf_counter())
+        pipe.finish()
+
+    writer_thread = threading.Thread(target=_write, name="pdf-writer", daemon=True)
+    writer_thread.start()
+    body = MultipartStreamBody(
+        "file", filename, pipe, content_type or "application/octet-stream"
+    )
+    try:
+        upload = _post_upload(session, upload_endpoint, body)
+    finally:
+        pipe.close()
+        writer_thread.join()
+    return upload, written[0]
+
+
+def _post_upload(session, upload_endpoint, body):
+    with indico_calls.time("file_upload"):
+        response = session.post(
+            upload_endpoint, data=body, headers={"Content-Type": body.content_type}
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+def process_pdf(
+    event,
+    file,
+    session,
+    upload_endpoint,
+    contrib_id=None,
+    editable_type=None,
+    cache_updates=None,
+):
+    """Watermark a PDF file and upload it.
+
+    :param cache_updates: a list to which the function storing the upload in
+                          the watermark cache is added, to call it once the
+                          upload has been attached to a revision; if not set,
+                          it is stored right away
+    """
+    config = current_app.config
+    source, source_hash = download_file(session, file["signed_download_url"])
+    version = watermark_template.version
+    cache_key = (
+        event.identifier,
+        source_hash,
+        version,
+        file["filename"],
+        file["content_type"],
+    )
+    with source, ExitStack() as stack:
+        uuid = watermark_cache.get(*cache_key)
+        if uuid is not None:
+            watermark_cache_lookups.inc("hit")
+            current_app.logger.info(
+                "Reusing watermarked file %s for %r", uuid, file["filename"]
+            )
+            return {"uuid": uuid}
+        if watermark_cache.enabled:
+            watermark_cache_lookups.inc("miss")
+        start = time.perf_counter()
+        pdf_reader = PdfFileReader(source)
+        num_pages = pdf_reader.numPages
+        watermark_pages.observe(num_pages)
+        engine = config["WATERMARK_ENGINE"]
+        page_cache = editable = None
+        if (
+            engine == "merge"
+            and config["WATERMARK_REUSE_PAGES"]
+            and watermark_cache.enabled
+            and contrib_id is not None
+        ):
+            editable = "{}/{}".format(contrib_id, editable_type)
+            page_cache = WatermarkedPages(
+                version, watermark_cache.get_pages(event.identifier, editable)
+            )
+        write = None
+        pool_size = config["PDF_PROCESS_POOL_SIZE"]
+        if pool_size and num_pages >= config["PDF_PROCESS_POOL_MIN_PAGES"]:
+            current_app.logger.info(
+                "Watermarking %d pages in %d processes", num_pages, pool_size
+            )
+            pool = get_process_pool(pool_size)
+            try:
+                write = stack.enter_context(
+                    merge_watermark_parallel(
+                        pool, source, num_pages, pool_size, page_cache, engine
+                    )
+                ).write
+            except BrokenProcessPool:
+                # e.g. a worker ran out of memory; the pool cannot be used
+                # anymore, so replace it and watermark the file in this process
+                current_app.logger.exception(
+                    "Process pool broken, watermarking %r in this process",
+                    file["filename"],
+                )
+                discard_process_pool(pool)
+                if page_cache is not None:
+                    # some shards may have been added already
+                    page_cache = WatermarkedPages(version, page_cache.known)
+        if write is None and config["PDF_PIPELINE_UPLOAD"]:
+            # each page is written as soon as it has been watermarked
+            write = partial(
+                write_watermarked, pdf_reader, page_cache=page_cache, engine=engine
+            )
+        elif write is None:
+            pdf_writer = PdfFileWriter()
+            merge_watermark(
+                pdf_reader, pdf_writer, page_cache=page_cache, engine=engine
+            )
+            write = pdf_writer.write
+        if config["PDF_PIPELINE_UPLOAD"]:
+            upload, written = upload_pipelined(
+                session,
                 upload_endpoint,
-                files={"file": (file["filename"], buf, file["content_type"])},
+                file["filename"],
+                write,
+                file["content_type"],
             )
-            return r.json()
+            watermark_duration.observe(written - start)
+        else:
+            with SpooledTemporaryFile(max_size=config["PDF_SPOOL_MAX_SIZE"]) as buf:
+                write(buf)
+                watermark_duration.observe(time.perf_counter() - start)
+                upload = upload_file(
+                    session,
+                    upload_endpoint,
+                    file["filename"],
+                    buf,
+                    file["content_type"],
+                )
+    if cache_updates is None:
+        watermark_cache.set(*cache_key, upload["uuid"])
+    else:
+        cache_updates.append(partial(watermark_cache.set, *cache_key, upload["uuid"]))
+    if page_cache is not None:
+        watermark_page_merges.inc("merged", amount=page_cache.num_merged)
+        watermark_page_merges.inc("reused", amount=page_cache.num_reused)
+        watermark_cache.set_pages(
+            event.identifier, editable, page_cache.added, page_cache.reused
+        )
+    return upload
+
+
+# The review logic below is split into the tag codes a review needs and a
+# pure function building the result from the tag catalog, so the same logic
+# is used by the asynchronous operations in `aio`.
+
+
+def _get_required_tags(event, require):
+    if not require:
+        return {}
+    session = get_requests_session(event)
+    return get_event_tags(session, event, require=require)
 
 
-def process_accepted_revision(event, revision):
+def accepted_revision_tags(revision):
+    return {"QA_APPROVED"} if revision["comment"] == "publish" else set()
+
+
+def review_accepted_revision(revision, available_tags):
     publish = False
-    session = setup_requests_session(event.token)
-    available_tags = get_event_tags(session, event)
     text = "This revision has been accepted but not published yet."
     if revision["comment"] == "publish":
         text = "This revision has been accepted for publishing."
@@ -159,9 +769,15 @@ def process_accepted_revision(event, revision):
     )
 
 
-def process_revision(event, revision, action):
-    session = setup_requests_session(event.token)
-    available_tags = get_event_tags(session, event)
+def process_accepted_revision(event, revision):
+    available_tags = _get_required_tags(event, accepted_revision_tags(revision))
+    return review_accepted_revision(revision, available_tags)
+
+
+REVISION_TAGS = {"OK_TITLE"}
+
+
+def review_revision(revision, action, available_tags):
     return dict(
         tags=[available_tags["OK_TITLE"]["id"]],
         comments=[
@@ -170,45 +786,67 @@ def process_revision(event, revision, action):
     )
 
 
-def _can_access_action(revision, action, user_is_editor):
-    if not user_is_editor:
-        return False
-    if revision["final_state"]["name"] == "accepted":
-        if any(t["code"] == "QA_APPROVED" for t in revision["tags"]):
-            return action == "fail-qa"
-        else:
-            return action == "approve-qa"
-    return action == "lol"
+def process_revision(event, revision, action):
+    available_tags = _get_required_tags(event, REVISION_TAGS)
+    return review_revision(revision, action, available_tags)
+
+
+def _is_accepted(revision):
+    return revision["final_state"]["name"] == "accepted"
 
 
-def get_custom_actions(event, revision, user_is_editor):
+def reviews_tags(reviews):
+    """Get the tag codes needed to review several revisions."""
+    required = set()
+    for review in reviews:
+        revision = review["revision"]
+        required |= (
+            accepted_revision_tags(revision)
+            if _is_accepted(revision)
+            else REVISION_TAGS
+        )
+    return required
+
+
+def review_revisions(reviews, available_tags):
     return [
-        a
-        for a in CUSTOM_ACTIONS
-        if _can_access_action(revision, a["name"], user_is_editor)
+        review_accepted_revision(review["revision"], available_tags)
+        if _is_accepted(review["revision"])
+        else review_revision(review["revision"], review["action"], available_tags)
+        for review in reviews
     ]
 
 
-def process_custom_action(event, revision, action, user_is_editor):
-    if not _can_access_action(revision, action, user_is_editor):
+def process_reviews(event, reviews):
+    """Review several revisions of an event at once.
+
+    The tag catalog is only looked up once for the whole batch.
+    """
+    available_tags = _get_required_tags(event, reviews_tags(reviews))
+    return review_revisions(reviews, available_tags)
+
+
+def render_custom_actions(event, revision, user_is_editor):
+    """Get the custom actions available for a revision as a JSON body.
+
+    :return: a ``(body, etag)`` tuple
+    """
+    return action_registry.render_available(revision, user_is_editor)
+
+
+def custom_action_tags(revision, action, user_is_editor):
+    if not action_registry.is_available(revision, action, user_is_editor):
+        return set()
+    return set(action_registry.get(action).needs_tags)
+
+
+def apply_custom_action(revision, action, user_is_editor, available_tags):
+    if not action_registry.is_available(revision, action, user_is_editor):
         return {}
-    if action == "lol":
-        return {
-            "redirect": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
-            "comments": [{"internal": True, "text": "Nice try. How about no?"}],
-        }
-    elif action == "approve-qa":
-        session = setup_requests_session(event.token)
-        available_tags = get_event_tags(session, event)
-        return {
-            "tags": [available_tags["QA_APPROVED"]["id"]],
-            "publish": True,
-            "comments": [{"internal": True, "text": "QA ok; publishing it"}],
-        }
-    elif action == "fail-qa":
-        return {
-            "tags": [],
-            "publish": False,
-            "comments": [{"internal": True, "text": "QA failed; unpublishing it"}],
-        }
-    return {}
+    return action_registry.get(action).apply(revision, available_tags)
+
+
+def process_custom_action(event, revision, action, user_is_editor):
+    required = custom_action_tags(revision, action, user_is_editor)
+    available_tags = _get_required_tags(event, required)
+    return apply_custom_action(revision, action, user_is_editor, available_tags)
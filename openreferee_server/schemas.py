@@ -1,4 +1,4 @@
-from marshmallow import EXCLUDE, Schema
+from marshmallow import EXCLUDE, Schema, validate
 from webargs import fields
 
 from .defaults import SERVICE_INFO
@@ -50,6 +50,11 @@ class EventInfoSchema(Schema):
         required=True,
         default=SERVICE_INFO,
     )
+    provisioning_state = fields.String(
+        attribute="provisioning_state.name",
+        description="Whether the event has been set up in Indico",
+    )
+    provisioning_error = fields.String(allow_none=True)
 
 
 class _BaseFileSchema(Schema):
@@ -131,6 +136,20 @@ class ReviewEditableSchema(Schema):
     endpoints = fields.Nested(EditableEndpointsSchema, required=True)
 
 
+class BulkReviewSchema(ReviewEditableSchema):
+    contrib_id = fields.Integer(required=True)
+    editable_type = fields.String(
+        required=True, validate=validate.OneOf(["paper", "slides", "poster"])
+    )
+    revision_id = fields.String(required=True)
+
+
+class BulkReviewEditablesSchema(Schema):
+    reviews = fields.List(
+        fields.Nested(BulkReviewSchema, unknown=EXCLUDE), required=True
+    )
+
+
 class CommentSchema(Schema):
     text = fields.String()
     internal = fields.Boolean()
@@ -210,3 +229,17 @@ class ServiceActionResultSchema(Schema):
     comments = fields.List(fields.Nested(CommentSchema))
     tags = fields.List(fields.Int())
     redirect = fields.String(missing=None)
+
+
+# schema instances are reusable, so create them only once
+create_editable_schema = CreateEditableSchema()
+review_editable_schema = ReviewEditableSchema(unknown=EXCLUDE)
+bulk_review_editables_schema = BulkReviewEditablesSchema(unknown=EXCLUDE)
+service_actions_request_schema = ServiceActionsRequestSchema(unknown=EXCLUDE)
+service_trigger_action_request_schema = ServiceTriggerActionRequestSchema(
+    unknown=EXCLUDE
+)
+event_info_schema = EventInfoSchema()
+review_response_schema = ReviewResponseSchema()
+service_actions_schema = ServiceActionSchema(many=True)
+service_action_result_schema = ServiceActionResultSchema()
@@ -1,71 +1,134 @@
+import difflib
+import hashlib
+import hmac
+import os
 import threading
-from functools import wraps
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial, wraps
 
 import click
-from flask import (
-    Blueprint,
-    copy_current_request_context,
-    current_app,
-    json,
-    jsonify,
-    request,
-)
-from marshmallow import EXCLUDE
+from flask import Blueprint, Response, current_app, g, json, jsonify, request
 from sqlalchemy.exc import IntegrityError
 from webargs.flaskparser import use_kwargs
-from werkzeug.exceptions import Conflict, NotFound, Unauthorized
+from werkzeug.exceptions import BadRequest, Conflict, NotFound, Unauthorized
 
+from .admission import limit_concurrency, webhook_limiter
 from .app import register_spec
 from .db import db
-from .defaults import DEFAULT_EDITABLES, SERVICE_INFO
-from .models import Event
+from .defaults import SERVICE_INFO
+from .idempotency import forget_event_requests, idempotent
+from .jobs import enqueue_job
+from .metrics import CONTENT_TYPE, http_requests, render_metrics
+from .models import Event, EventRecord, ProvisioningState
 from .operations import (
     cleanup_event,
-    get_custom_actions,
+    event_cache,
+    invalidate_event_caches,
     process_accepted_revision,
     process_custom_action,
-    process_editable_files,
+    process_reviews,
     process_revision,
-    setup_event_tags,
-    setup_file_types,
-    setup_requests_session,
+    provision_event,
+    render_custom_actions,
+    tag_cache,
 )
 from .schemas import (
-    CreateEditableSchema,
-    EventInfoSchema,
     EventSchema,
-    ReviewEditableSchema,
-    ReviewResponseSchema,
-    ServiceActionResultSchema,
-    ServiceActionSchema,
-    ServiceActionsRequestSchema,
-    ServiceTriggerActionRequestSchema,
+    bulk_review_editables_schema,
+    create_editable_schema,
+    event_info_schema,
+    review_editable_schema,
+    review_response_schema,
+    service_action_result_schema,
+    service_actions_request_schema,
+    service_trigger_action_request_schema,
 )
+from .validation import use_json_kwargs
+
+
+def _token_digest(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+def _get_event_record(identifier):
+    record = event_cache.get(identifier)
+    if record is None:
+        event = Event.query.get(identifier)
+        if event is None:
+            return None
+        record = (_token_digest(event.token), event.url, event.endpoints)
+        event_cache.set(identifier, record)
+    return record
+
 
+def require_event_token(fn=None, *, load_event=False):
+    """Authenticate a request for an event using its bearer token.
+
+    By default the event is looked up in `event_cache` and passed to the
+    view as a detached `EventRecord`; views which need the actual `Event`
+    (e.g. to modify it) must set `load_event`.
+    """
+    if fn is None:
+        return partial(require_event_token, load_event=load_event)
 
-def require_event_token(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
         identifier = kwargs.pop("identifier")
-        event = Event.query.get(identifier)
-        if event is None:
-            raise NotFound("Unknown event")
         auth = request.headers.get("Authorization")
-        token = None
-        if auth and auth.startswith("Bearer "):
-            token = auth[7:]
-        if not token:
-            raise Unauthorized("Token missing")
-        elif token != event.token:
-            raise Unauthorized("Invalid token")
+        event = authenticate_event(identifier, auth, load_event=load_event)
         return fn(*args, event=event, **kwargs)
 
     return wrapper
 
 
+def authenticate_event(identifier, auth, load_event=False):
+    """Get an event after checking the ``Authorization`` header value.
+
+    :raise NotFound: if the event does not exist
+    :raise Unauthorized: if the bearer token is missing or invalid
+    """
+    if load_event:
+        event = Event.query.get(identifier)
+        token_digest = _token_digest(event.token) if event is not None else None
+    else:
+        record = _get_event_record(identifier)
+        token_digest = record[0] if record is not None else None
+    if token_digest is None:
+        raise NotFound("Unknown event")
+    token = None
+    if auth and auth.startswith("Bearer "):
+        token = auth[7:]
+    if not token:
+        raise Unauthorized("Token missing")
+    elif not hmac.compare_digest(_token_digest(token), token_digest):
+        raise Unauthorized("Invalid token")
+    if not load_event:
+        # the token has just been verified, so we don't need to cache it
+        event = EventRecord(identifier, record[1], token, record[2])
+    return event
+
+
 api = Blueprint("api", __name__, cli_group=None)
 
 
+@api.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@api.after_request
+def _record_request(response):
+    start = g.pop("request_start", None)
+    if start is not None and request.endpoint:
+        http_requests.observe(
+            time.perf_counter() - start,
+            request.endpoint.partition(".")[2],
+            response.status_code,
+        )
+    return response
+
+
 @api.route("/info")
 def info():
     """Get service info
@@ -85,6 +148,22 @@ def info():
     return jsonify(SERVICE_INFO)
 
 
+@api.route("/stats/caches")
+def cache_stats():
+    # internal monitoring endpoint, not part of the OpenReferee API
+    return jsonify(
+        events=event_cache.stats(),
+        tags=tag_cache.stats(),
+        webhooks=webhook_limiter.stats(),
+    )
+
+
+@api.route("/metrics")
+def metrics():
+    # internal monitoring endpoint in the Prometheus text format
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 @api.route("/event/<identifier>", methods=("PUT",))
 @use_kwargs(EventSchema, location="json")
 def create_event(identifier, title, url, token, endpoints):
@@ -107,6 +186,8 @@ def create_event(identifier, title, url, token, endpoints):
           content:
             application/json:
               schema: SuccessSchema
+        202:
+          description: Event Created, provisioning in progress
     """
     event = Event(
         identifier=identifier,
@@ -121,24 +202,29 @@ def create_event(identifier, title, url, token, endpoints):
     except IntegrityError:
         raise Conflict("Event already exists")
     current_app.logger.info("Registered event %r", event)
+    event_cache.pop(identifier)
 
-    session = setup_requests_session(token)
-    setup_event_tags(session, event)
-
-    response = session.post(
-        endpoints["editable_types"],
-        json={"editable_types": list(DEFAULT_EDITABLES)},
-    )
-    response.raise_for_status()
-
-    setup_file_types(session, event)
+    if current_app.config["PROVISION_ASYNC"]:
+        enqueue_job(event, "provision")
+        db.session.commit()
+        return "", 202
 
+    # don't keep the transaction open while talking to Indico
+    db.session.commit()
+    try:
+        provision_event(event)
+    except Exception:
+        db.session.delete(event)
+        db.session.commit()
+        invalidate_event_caches(event)
+        raise
+    event.provisioning_state = ProvisioningState.done
     db.session.commit()
     return "", 201
 
 
 @api.route("/event/<identifier>", methods=("DELETE",))
-@require_event_token
+@require_event_token(load_event=True)
 def remove_event(event):
     """Remove an Event.
     ---
@@ -161,12 +247,18 @@ def remove_event(event):
     cleanup_event(event)
     db.session.delete(event)
     db.session.commit()
-    current_app.logger.info("Unregistered event %r", event)
+    _forget_event(event)
     return "", 204
 
 
+def _forget_event(event):
+    invalidate_event_caches(event)
+    forget_event_requests(event)
+    current_app.logger.info("Unregistered event %r", event)
+
+
 @api.route("/event/<identifier>")
-@require_event_token
+@require_event_token(load_event=True)
 def get_event_info(event):
     """Get information about an event
     ---
@@ -186,15 +278,17 @@ def get_event_info(event):
             application/json:
               schema: EventInfoSchema
     """
-    return EventInfoSchema().dump(event)
+    return event_info_schema.dump(event)
 
 
 @api.route(
     "/event/<identifier>/editable/<any(paper,slides,poster):editable_type>/<contrib_id>",
     methods=("PUT",),
 )
-@use_kwargs(CreateEditableSchema, location="json")
+@use_json_kwargs(create_editable_schema)
 @require_event_token
+@limit_concurrency
+@idempotent
 def create_editable(event, contrib_id, editable_type, editable, revision, endpoints):
     """A new editable is created
     ---
@@ -218,21 +312,17 @@ def create_editable(event, contrib_id, editable_type, editable, revision, endpoi
     current_app.logger.info(
         "A new %r editable was submitted for contribution %r", editable_type, contrib_id
     )
-    session = setup_requests_session(event.token)
-
-    @copy_current_request_context
-    def watermark_revision_files():
-        """Wait until the revision has been committed"""
-        response = session.get(endpoints["revisions"]["details"])
-        if response.status_code == 200:
-            process_editable_files(session, event, revision["files"], endpoints)
-            return
-
-        t = threading.Timer(5.0, watermark_revision_files)
-        t.daemon = True
-        t.start()
-
-    watermark_revision_files()
+    # the revision is only committed by Indico once we replied, so the files
+    # are watermarked by a background worker
+    enqueue_job(
+        event,
+        "watermark",
+        files=revision["files"],
+        endpoints=endpoints,
+        contrib_id=contrib_id,
+        editable_type=editable_type,
+    )
+    db.session.commit()
     return "", 201
 
 
@@ -240,8 +330,10 @@ def create_editable(event, contrib_id, editable_type, editable, revision, endpoi
     "/event/<identifier>/editable/<any(paper,slides,poster):editable_type>/<contrib_id>/<revision_id>",
     methods=("POST",),
 )
-@use_kwargs(ReviewEditableSchema(unknown=EXCLUDE), location="json")
+@use_json_kwargs(review_editable_schema)
 @require_event_token
+@limit_concurrency
+@idempotent
 def review_editable(
     event, contrib_id, editable_type, revision_id, action, revision, endpoints
 ):
@@ -274,14 +366,49 @@ def review_editable(
         resp = process_accepted_revision(event, revision)
     else:
         resp = process_revision(event, revision, action)
-    return ReviewResponseSchema().dump(resp), 201
+    return review_response_schema.dump(resp), 201
+
+
+@api.route("/event/<identifier>/reviews", methods=("POST",))
+@use_json_kwargs(bulk_review_editables_schema)
+@require_event_token
+def review_editables(event, reviews):
+    """Several revisions are created at once
+    ---
+    post:
+      description: Called with a batch of revisions, e.g. when judging many at once
+      operationId: reviewEditables
+      tags: ["editable", "review"]
+      security:
+        - bearer_token: []
+      requestBody:
+        content:
+          application/json:
+            schema: BulkReviewEditablesSchema
+      parameters:
+        - in: path
+          schema: IdentifierParameter
+      responses:
+        201:
+          description: Reviews processed, in the order of the submitted revisions
+          content:
+            application/json:
+              schema:
+                type: array
+                items: ReviewResponseSchema
+    """
+    if len(reviews) > current_app.config["BULK_REVIEW_MAX_SIZE"]:
+        raise BadRequest("Too many revisions")
+    current_app.logger.info("%d new revisions were submitted", len(reviews))
+    resp = process_reviews(event, reviews)
+    return jsonify(review_response_schema.dump(resp, many=True)), 201
 
 
 @api.route(
     "/event/<identifier>/editable/<any(paper,slides,poster):editable_type>/<contrib_id>/<revision_id>/actions",
     methods=("POST",),
 )
-@use_kwargs(ServiceActionsRequestSchema(unknown=EXCLUDE), location="json")
+@use_json_kwargs(service_actions_request_schema)
 @require_event_token
 def get_custom_revision_actions(
     event,
@@ -316,21 +443,27 @@ def get_custom_revision_actions(
               schema:
                 type: array
                 items: ServiceActionSchema
+        304:
+          description: The actions match the ETag sent in If-None-Match
     """
-
-    return jsonify(
-        ServiceActionSchema(many=True).dump(
-            get_custom_actions(event, revision, user_is_editor)
-        )
-    )
+    body, etag = render_custom_actions(event, revision, user_is_editor)
+    # the actions only depend on the revision and user, so Indico can send
+    # back the ETag of a previous response even though this is a POST
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
 
 
 @api.route(
     "/event/<identifier>/editable/<any(paper,slides,poster):editable_type>/<contrib_id>/<revision_id>/action",
     methods=("POST",),
 )
-@use_kwargs(ServiceTriggerActionRequestSchema(unknown=EXCLUDE), location="json")
+@use_json_kwargs(service_trigger_action_request_schema)
 @require_event_token
+@limit_concurrency
 def custom_revision_action(
     event,
     contrib_id,
@@ -368,7 +501,59 @@ def custom_revision_action(
     """
 
     resp = process_custom_action(event, revision, action, user_is_editor)
-    return jsonify(ServiceActionResultSchema().dump(resp))
+    return jsonify(service_action_result_schema.dump(resp))
+
+
+def build_spec(test=False, host=None, port=None):
+    """Build the OpenAPI spec from the docstrings of the API views."""
+    with current_app.test_request_context():
+        spec = register_spec(test=test, test_host=host, test_port=port)
+        spec.path(view=info)
+        spec.path(view=create_event)
+        spec.path(view=remove_event)
+        spec.path(view=get_event_info)
+        spec.path(view=create_editable)
+        spec.path(view=review_editable)
+        spec.path(view=review_editables)
+        spec.path(view=get_custom_revision_actions)
+        spec.path(view=custom_revision_action)
+    return spec
+
+
+_spec_lock = threading.Lock()
+
+
+def get_spec():
+    """Get the rendered OpenAPI spec, building it on first use.
+
+    :return: a dict mapping the formats (``json`` and ``yaml``) to
+             ``(content, etag)`` tuples
+    """
+    rendered = current_app.extensions.get("openreferee_spec")
+    if rendered is not None:
+        return rendered
+    with _spec_lock:
+        rendered = current_app.extensions.get("openreferee_spec")
+        if rendered is None:
+            spec = build_spec()
+            rendered = {}
+            for fmt, content in (
+                ("json", json.dumps(spec.to_dict())),
+                ("yaml", spec.to_yaml()),
+            ):
+                rendered[fmt] = (content, hashlib.sha256(content.encode()).hexdigest())
+            current_app.extensions["openreferee_spec"] = rendered
+    return rendered
+
+
+@api.route("/openapi.<any(json,yaml):fmt>")
+def openapi(fmt):
+    content, etag = get_spec()[fmt]
+    response = Response(
+        content, mimetype="application/json" if fmt == "json" else "application/yaml"
+    )
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 @api.cli.command("openapi")
@@ -385,20 +570,109 @@ def custom_revision_action(
 )
 @click.option("--host", "-h")
 @click.option("--port", "-p")
-def _openapi(test, as_json, host, port):
+@click.option(
+    "--check",
+    "check_file",
+    is_flag=False,
+    flag_value="",
+    type=click.Path(dir_okay=False),
+    help="Compare the spec with a file (defaults to specs/openreferee.yaml)",
+)
+def _openapi(test, as_json, host, port, check_file):
     """Generate OpenAPI metadata from Flask app."""
-    with current_app.test_request_context():
-        spec = register_spec(test=test, test_host=host, test_port=port)
-        spec.path(view=info)
-        spec.path(view=create_event)
-        spec.path(view=remove_event)
-        spec.path(view=get_event_info)
-        spec.path(view=create_editable)
-        spec.path(view=review_editable)
-        spec.path(view=get_custom_revision_actions)
-        spec.path(view=custom_revision_action)
+    if check_file is not None:
+        _check_spec(check_file)
+        return
+    spec = build_spec(test=test, host=host, port=port)
+    if as_json:
+        print(json.dumps(spec.to_dict()))
+    else:
+        print(spec.to_yaml())
+
 
-        if as_json:
-            print(json.dumps(spec.to_dict()))
-        else:
-            print(spec.to_yaml())
+def _check_spec(path):
+    if not path:
+        path = os.path.join(
+            os.path.dirname(current_app.root_path), "specs", "openreferee.yaml"
+        )
+    with open(path) as f:
+        expected = f.read().rstrip("\n").splitlines()
+    actual = get_spec()["yaml"][0].rstrip("\n").splitlines()
+    if actual != expected:
+        click.echo(
+            "\n".join(
+                difflib.unified_diff(expected, actual, path, "generated", lineterm="")
+            )
+        )
+        raise click.ClickException("The OpenAPI spec is out of date")
+    click.echo("The OpenAPI spec is up to date")
+
+
+@api.cli.group("events")
+def _events():
+    """Manage the registered events."""
+
+
+@_events.command("remove")
+@click.argument("identifiers", nargs=-1)
+@click.option(
+    "--from-file",
+    type=click.File(),
+    help="Read the event identifiers from a file, one per line",
+)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=int,
+    help="Number of events cleaned up in parallel "
+    "(defaults to PROVISIONING_CONCURRENCY)",
+)
+def _remove_events(identifiers, from_file, concurrency):
+    """Remove events like Indico does when unregistering them.
+
+    Events whose cleanup failed are kept, so the command can be run again.
+    """
+    identifiers = set(identifiers)
+    if from_file:
+        identifiers.update(line.strip() for line in from_file if line.strip())
+    if not identifiers:
+        raise click.UsageError("Specify event identifiers or --from-file")
+    events = [
+        EventRecord(e.identifier, e.url, e.token, e.endpoints)
+        for e in Event.query.filter(Event.identifier.in_(identifiers))
+    ]
+    for identifier in sorted(identifiers - {e.identifier for e in events}):
+        click.echo("Unknown event: {}".format(identifier), err=True)
+
+    app = current_app._get_current_object()
+    concurrency = concurrency or app.config["PROVISIONING_CONCURRENCY"]
+
+    def _cleanup(event):
+        with app.app_context():
+            cleanup_event(event)
+
+    cleaned_up = []
+    errors = {}
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="remove") as pool:
+        futures = {pool.submit(_cleanup, event): event for event in events}
+        with click.progressbar(
+            as_completed(futures), length=len(futures), label="Cleaning up events"
+        ) as bar:
+            for future in bar:
+                if future.exception():
+                    errors[futures[future]] = future.exception()
+                else:
+                    cleaned_up.append(futures[future])
+
+    # their jobs and stored responses are deleted by the database cascade
+    Event.query.filter(Event.identifier.in_([e.identifier for e in cleaned_up])).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    for event in cleaned_up:
+        _forget_event(event)
+    click.echo("Removed {} events".format(len(cleaned_up)))
+    if errors:
+        for event, exc in errors.items():
+            click.echo("Could not clean up {}: {}".format(event.identifier, exc))
+        raise click.ClickException("{} events could not be removed".format(len(errors)))
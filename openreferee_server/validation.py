@@ -0,0 +1,227 @@
+"""Fast loading of webhook payloads.
+
+Deserializing the large nested payloads Indico sends with marshmallow is
+comparatively slow.  `compile_loader` generates a plain function from a
+schema which loads a payload with the same result as marshmallow, as long
+as it is structurally valid and only uses the basic JSON types.  Anything
+else (invalid data, values marshmallow would have to convert, unsupported
+fields) makes it bail out, so the payload is loaded by marshmallow, which
+also produces the usual error messages.
+"""
+
+from functools import wraps
+
+from flask import current_app, request
+from marshmallow import EXCLUDE, INCLUDE, RAISE, fields, missing, validate
+from webargs.flaskparser import use_kwargs
+
+
+class _Invalid(Exception):
+    """Raised by a compiled loader to fall back to marshmallow."""
+
+
+class _Unsupported(Exception):
+    """Raised while compiling a schema which cannot be loaded quickly."""
+
+
+def _load_string(value):
+    if type(value) is not str:
+        raise _Invalid
+    return value
+
+
+def _load_integer(value):
+    if type(value) is not int:
+        raise _Invalid
+    return value
+
+
+def _load_boolean(value):
+    if type(value) is not bool:
+        raise _Invalid
+    return value
+
+
+_SIMPLE_FIELDS = {
+    fields.String: _load_string,
+    fields.Integer: _load_integer,
+    fields.Boolean: _load_boolean,
+}
+
+
+def _compile_validator(validator, load):
+    if type(validator) is validate.OneOf:
+        choices = frozenset(validator.choices)
+
+        def load_choice(value):
+            value = load(value)
+            if value not in choices:
+                raise _Invalid
+            return value
+
+        return load_choice
+    raise _Unsupported
+
+
+def _compile_field(field):
+    load = _compile_type(field)
+    for validator in field.validators:
+        load = _compile_validator(validator, load)
+    if not field.allow_none:
+        return load
+    return lambda value: None if value is None else load(value)
+
+
+def _compile_type(field):
+    if type(field) in _SIMPLE_FIELDS:
+        load = _SIMPLE_FIELDS[type(field)]
+    elif isinstance(field, fields.Nested):
+        if field.only or field.exclude:
+            raise _Unsupported
+        load = _compile_schema(field.schema, field.unknown or field.schema.unknown)
+        if field.many:
+            load = _compile_list(load)
+    elif type(field) is fields.List:
+        load = _compile_list(_compile_field(field.inner))
+    elif type(field) is fields.Dict:
+        load = _compile_dict(
+            _compile_field(field.key_field) if field.key_field else None,
+            _compile_field(field.value_field) if field.value_field else None,
+        )
+    else:
+        raise _Unsupported
+    return load
+
+
+def _compile_list(load_item):
+    def load(value):
+        if type(value) is not list:
+            raise _Invalid
+        return [load_item(item) for item in value]
+
+    return load
+
+
+def _compile_dict(load_key, load_value):
+    def load(value):
+        if type(value) is not dict:
+            raise _Invalid
+        return {
+            load_key(k) if load_key else k: load_value(v) if load_value else v
+            for k, v in value.items()
+        }
+
+    return load
+
+
+def _compile_schema(schema, unknown):
+    # processors and validators may change or reject anything
+    if any(schema._hooks.values()):
+        raise _Unsupported
+    specs = []
+    for name, field in schema.load_fields.items():
+        attribute = field.attribute or name
+        if "." in attribute:
+            raise _Unsupported
+        specs.append(
+            (
+                field.data_key or name,
+                attribute,
+                _compile_field(field),
+                field.required,
+                field.missing,
+            )
+        )
+    known = {spec[0] for spec in specs}
+
+    def load(value):
+        if type(value) is not dict:
+            raise _Invalid
+        if unknown == INCLUDE:
+            result = {k: v for k, v in value.items() if k not in known}
+        elif unknown == RAISE and not value.keys() <= known:
+            raise _Invalid
+        else:
+            result = {}
+        for key, attribute, load_field, required, default in specs:
+            if key in value:
+                result[attribute] = load_field(value[key])
+            elif required:
+                raise _Invalid
+            elif default is not missing:
+                result[attribute] = default() if callable(default) else default
+        return result
+
+    return load
+
+
+_loaders = {}
+
+
+def compile_loader(schema):
+    """Get a fast loader for a schema instance.
+
+    The loader returns the loaded data, or `None` if the data needs to be
+    loaded by marshmallow.  If the schema cannot be loaded quickly at all,
+    `None` is returned instead of a loader.
+    """
+    try:
+        return _loaders[schema]
+    except KeyError:
+        pass
+    if schema.many or schema.unknown not in (EXCLUDE, INCLUDE, RAISE):
+        compiled = None
+    else:
+        try:
+            compiled = _compile_schema(schema, schema.unknown)
+        except _Unsupported:
+            compiled = None
+    if compiled is None:
+        loader = None
+    else:
+
+        def loader(data):
+            try:
+                return compiled(data)
+            except _Invalid:
+                return None
+
+    _loaders[schema] = loader
+    return loader
+
+
+def _fast_load(schema, data):
+    if not current_app.config["FAST_PAYLOAD_VALIDATION"]:
+        return None
+    loader = compile_loader(schema)
+    return loader(data) if loader is not None else None
+
+
+def load_payload(schema, data):
+    """Load data with a schema, using the fast path if possible."""
+    result = _fast_load(schema, data)
+    return result if result is not None else schema.load(data)
+
+
+def use_json_kwargs(schema):
+    """Like ``use_kwargs(schema, location="json")`` with a fast path.
+
+    Payloads which cannot be loaded quickly, including invalid ones, are
+    parsed by webargs as usual.
+    """
+    parse_kwargs = use_kwargs(schema, location="json")
+
+    def decorator(fn):
+        parse_and_call = parse_kwargs(fn)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            data = _fast_load(schema, request.get_json(silent=True))
+            if data is None:
+                return parse_and_call(*args, **kwargs)
+            kwargs.update(data)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,644 @@
+import codecs
+import hashlib
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    createStringObject,
+)
+from PyPDF2.pdf import ContentStream, PageObject
+
+
+WATERMARK_PATH = Path(__file__).parent / "watermark.pdf"
+
+
+class _ObjectStore:
+    """A minimal stand-in for a PDF reader holding fully resolved objects.
+
+    `IndirectObject` references pointing to a store are resolved from
+    memory, so using them never touches a file.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def getObject(self, ref):
+        return self.objects[ref.idnum, ref.generation]
+
+
+def _copy_object(obj, store, map_reference=None):
+    """Copy a PDF object, binding indirect references to `store`.
+
+    Immutable leaf objects (names, numbers, strings) are shared.
+
+    :param map_reference: a function getting the reference to use in the
+                          copy instead of an indirect reference
+    """
+    if isinstance(obj, IndirectObject):
+        if map_reference is not None:
+            return map_reference(obj)
+        return IndirectObject(obj.idnum, obj.generation, store)
+    elif isinstance(obj, StreamObject):
+        # a content stream serializes its operations when its data is read
+        copy = (
+            DecodedStreamObject() if isinstance(obj, ContentStream) else obj.__class__()
+        )
+        copy._data = obj._data
+    elif isinstance(obj, PageObject):
+        copy = PageObject(store)
+    elif isinstance(obj, DictionaryObject):
+        copy = DictionaryObject()
+    elif isinstance(obj, ArrayObject):
+        return obj.__class__([_copy_object(x, store, map_reference) for x in obj])
+    else:
+        return obj
+    copy.update((k, _copy_object(v, store, map_reference)) for k, v in obj.items())
+    return copy
+
+
+def _iter_references(obj):
+    if isinstance(obj, IndirectObject):
+        yield obj
+    elif isinstance(obj, DictionaryObject):
+        for value in obj.values():
+            yield from _iter_references(value)
+    elif isinstance(obj, ArrayObject):
+        for value in obj:
+            yield from _iter_references(value)
+
+
+class WatermarkTemplate:
+    """The watermark page, parsed once per process.
+
+    The page and everything it references are resolved into memory when
+    first needed, with the content stream already decoded.  Since
+    `PdfFileWriter` rewrites the objects it writes in place, every caller
+    gets its own copy of that object graph, which is cheap compared to
+    parsing the file again.  The template is reloaded whenever the
+    modification time of the file changes.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        # (mtime, version, page, store) of the currently loaded file
+        self._template = None
+
+    def _get_template(self):
+        mtime = self.path.stat().st_mtime_ns
+        template = self._template
+        if template is None or template[0] != mtime:
+            with self._lock:
+                if self._template is None or self._template[0] != mtime:
+                    self._template = (mtime, *self._load())
+                template = self._template
+        return template
+
+    @property
+    def version(self):
+        """A hash identifying the contents of the watermark file."""
+        return self._get_template()[1]
+
+    def get_page(self):
+        """Get a copy of the watermark page ready for `mergePage`."""
+        _, _, page, store = self._get_template()
+        copy = _ObjectStore()
+        copy.objects = {k: _copy_object(v, copy) for k, v in store.objects.items()}
+        return _copy_object(page, copy)
+
+    def _load(self):
+        data = self.path.read_bytes()
+        reader = PdfFileReader(BytesIO(data))
+        source_page = reader.getPage(0)
+        # the parent is only needed to navigate the page tree of the source file
+        page = {k: v for k, v in source_page.items() if k != "/Parent"}
+        contents = DecodedStreamObject()
+        contents.setData(ContentStream(source_page.getContents(), reader).getData())
+        page[NameObject("/Contents")] = contents
+
+        store = _ObjectStore()
+        pending = [ref for v in page.values() for ref in _iter_references(v)]
+        while pending:
+            ref = pending.pop()
+            key = ref.idnum, ref.generation
+            if key in store.objects:
+                continue
+            obj = reader.getObject(ref)
+            store.objects[key] = _copy_object(obj, store)
+            pending.extend(_iter_references(obj))
+
+        template_page = PageObject(store)
+        template_page.update((k, _copy_object(v, store)) for k, v in page.items())
+        return hashlib.sha256(data).hexdigest(), template_page, store
+
+
+watermark_template = WatermarkTemplate(WATERMARK_PATH)
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool(max_workers):
+    """Get the process pool used to watermark large documents.
+
+    The workers are spawned rather than forked since the pool is created
+    from processes running several threads.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def discard_process_pool(pool):
+    """Stop using a broken process pool, e.g. after a worker was killed.
+
+    The next call to `get_process_pool` creates a new pool.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+
+_RESOURCE_TYPES = (
+    "/ExtGState",
+    "/Font",
+    "/XObject",
+    "/ColorSpace",
+    "/Pattern",
+    "/Shading",
+    "/Properties",
+)
+
+
+class WatermarkedPages:
+    """The watermarked content streams of pages, to reuse them.
+
+    Revisions of a document usually only differ in a few pages.  A page is
+    identified by a fingerprint of its content streams, the watermark and
+    the resources which have to be renamed when merging the watermark into
+    it; for pages with a known fingerprint only the resource dictionaries
+    are merged and the known content stream is used, so their content is
+    never parsed.  This gives the same result as `PageObject.mergePage`.
+
+    :param version: the version of the watermark
+    :param known: a dict mapping the fingerprints of previously watermarked
+                  pages to ``(content, renames)`` tuples
+    """
+
+    def __init__(self, version, known=None):
+        self.version = version
+        self.known = known or {}
+        # the fingerprints of the pages merged or reused so far
+        self.added = {}
+        self.reused = set()
+        self.num_merged = 0
+        self.num_reused = 0
+
+    def update(self, other):
+        """Include the pages merged or reused by another instance."""
+        self.added.update(other.added)
+        self.reused.update(other.reused)
+        self.num_merged += other.num_merged
+        self.num_reused += other.num_reused
+
+    def _get_fingerprint(self, page, renames):
+        digest = hashlib.sha256(self.version.encode())
+        for res, rename in sorted(renames.items()):
+            for key in sorted(rename):
+                digest.update("{}{}\0".format(res, key).encode())
+        contents = page.getContents()
+        if contents is None:
+            contents = []
+        elif not isinstance(contents, ArrayObject):
+            contents = [contents]
+        for stream in contents:
+            data = stream.getObject().getData()
+            digest.update(b"\1%d\0" % len(data))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def merge(self, page, watermark_page):
+        """Merge the watermark into a page like `PageObject.mergePage`."""
+        resources = page["/Resources"].getObject()
+        watermark_resources = watermark_page["/Resources"].getObject()
+        merged_resources = DictionaryObject()
+        renames = {}
+        for res in _RESOURCE_TYPES:
+            merged, rename = PageObject._mergeResources(
+                resources, watermark_resources, res
+            )
+            if merged:
+                merged_resources[NameObject(res)] = merged
+                if rename:
+                    renames[res] = rename
+        merged_resources[NameObject("/ProcSet")] = ArrayObject(
+            frozenset(resources.get("/ProcSet", ArrayObject()).getObject()).union(
+                frozenset(
+                    watermark_resources.get("/ProcSet", ArrayObject()).getObject()
+                )
+            )
+        )
+
+        fingerprint = self._get_fingerprint(page, renames)
+        known = self.known.get(fingerprint) or self.added.get(fingerprint)
+        if known is not None:
+            content, known_renames = known
+            # the resources are renamed randomly, so use the names the known
+            # content refers to
+            for res, rename in renames.items():
+                merged = merged_resources[res]
+                for key, name in rename.items():
+                    merged[NameObject(known_renames[res][key])] = merged.pop(name)
+            if fingerprint in self.known:
+                self.reused.add(fingerprint)
+            self.num_reused += 1
+        else:
+            content = self._merge_contents(page, watermark_page, renames)
+            self.added[fingerprint] = (
+                content,
+                {res: dict(rename) for res, rename in renames.items()},
+            )
+            self.num_merged += 1
+
+        annots = ArrayObject()
+        for source in (page, watermark_page):
+            if isinstance(source.get("/Annots"), ArrayObject):
+                annots.extend(source["/Annots"])
+        contents = DecodedStreamObject()
+        contents.setData(content)
+        page[NameObject("/Contents")] = contents
+        page[NameObject("/Resources")] = merged_resources
+        page[NameObject("/Annots")] = annots
+
+    def _merge_contents(self, page, watermark_page, renames):
+        rename = {}
+        for res_rename in renames.values():
+            rename.update(res_rename)
+        streams = ArrayObject()
+        contents = page.getContents()
+        if contents is not None:
+            streams.append(PageObject._pushPopGS(contents, page.pdf))
+        contents = PageObject._contentStreamRename(
+            watermark_page.getContents(), rename, page.pdf
+        )
+        streams.append(PageObject._pushPopGS(contents, page.pdf))
+        return ContentStream(streams, page.pdf).getData()
+
+
+class WatermarkOverlay:
+    """Draw the watermark on pages as a Form XObject shared by all of them.
+
+    Instead of merging the content streams and resources of the watermark
+    into every page, the watermark page is turned into a single form which
+    is added to the resources of each page and drawn after the content of
+    the page.  Like with `PageObject.mergePage`, the content of the page is
+    wrapped in ``q``/``Q`` so it cannot affect the watermark, but it is
+    never parsed, and the form and the streams wrapping the content are
+    shared by all pages, so they are only written once per document.  The
+    form is clipped to the media box of the watermark page.
+
+    :param watermark_page: a copy of the watermark page from
+                           `WatermarkTemplate.get_page`; the new objects
+                           are added to its object store
+    """
+
+    name = "/OpenRefereeWatermark"
+
+    def __init__(self, watermark_page):
+        self._store = watermark_page.pdf
+        form = DecodedStreamObject()
+        form.setData(watermark_page.getContents().getData())
+        form.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject(watermark_page.mediaBox),
+                NameObject("/Resources"): watermark_page["/Resources"],
+            }
+        )
+        self.form = self._add(form)
+        self._annots = watermark_page.get("/Annots")
+        self._push = self._add_stream(b"q\n")
+        # name of the form -> stream drawing it
+        self._draw = {}
+
+    def _add(self, obj):
+        idnum = max((idnum for idnum, __ in self._store.objects), default=0) + 1
+        self._store.objects[idnum, 0] = obj
+        return IndirectObject(idnum, 0, self._store)
+
+    def _add_stream(self, data):
+        stream = DecodedStreamObject()
+        stream.setData(data)
+        return self._add(stream)
+
+    def _get_name(self, xobjects):
+        # pages sharing their resources get the same name
+        name = self.name
+        suffix = 0
+        while xobjects.get(name, self.form) != self.form:
+            suffix += 1
+            name = "{}{}".format(self.name, suffix)
+        return NameObject(name)
+
+    def apply(self, page):
+        """Add the watermark to a page."""
+        if "/Resources" not in page:
+            page[NameObject("/Resources")] = DictionaryObject()
+        resources = page["/Resources"]
+        if "/XObject" not in resources:
+            resources[NameObject("/XObject")] = DictionaryObject()
+        xobjects = resources["/XObject"]
+        name = self._get_name(xobjects)
+        xobjects[name] = self.form
+        draw = self._draw.get(name)
+        if draw is None:
+            draw = self._draw[name] = self._add_stream(
+                b"\nQ\nq %s Do Q\n" % name.encode()
+            )
+
+        contents = page.get("/Contents")
+        if contents is None:
+            contents = []
+        elif isinstance(contents.getObject(), ArrayObject):
+            contents = list(contents.getObject())
+        else:
+            contents = [contents]
+        page[NameObject("/Contents")] = ArrayObject([self._push, *contents, draw])
+        if isinstance(self._annots, ArrayObject):
+            annots = page.get("/Annots")
+            annots = ArrayObject(annots.getObject() if annots is not None else ())
+            annots.extend(self._annots)
+            page[NameObject("/Annots")] = annots
+
+
+WATERMARK_ENGINES = ("merge", "overlay")
+
+
+def get_watermarker(engine="merge", page_cache=None):
+    """Get a function adding the watermark to the pages of a document.
+
+    :param engine: ``merge`` to merge the watermark into the content of
+                   every page, ``overlay`` to draw it as a `WatermarkOverlay`
+    :param page_cache: a `WatermarkedPages` to reuse the content of
+                       unchanged pages; only used with the ``merge`` engine
+    """
+    watermark_page = watermark_template.get_page()
+    if engine == "overlay":
+        return WatermarkOverlay(watermark_page).apply
+    elif engine != "merge":
+        raise ValueError("Unknown watermark engine: {}".format(engine))
+    elif page_cache is not None:
+        return partial(page_cache.merge, watermark_page=watermark_page)
+    return partial(PageObject.mergePage, page2=watermark_page)
+
+
+def merge_watermark(
+    pdf_reader, pdf_writer, start=0, stop=None, page_cache=None, engine="merge"
+):
+    """Add the watermarked pages of `pdf_reader` to `pdf_writer`.
+
+    :param page_cache: a `WatermarkedPages` to reuse the content of
+                       unchanged pages
+    :param engine: the engine adding the watermark (see `get_watermarker`)
+    """
+    watermark = get_watermarker(engine, page_cache)
+    if stop is None:
+        stop = pdf_reader.numPages
+    for i in range(start, stop):
+        page = pdf_reader.getPage(i)
+        watermark(page)
+        pdf_writer.addPage(page)
+
+
+class IncrementalPdfWriter:
+    """Write a PDF document page by page.
+
+    `PdfFileWriter` only serializes a document once all its pages have been
+    added.  This writer writes every page as soon as it is added, along with
+    the objects it references which have not been written yet, and the page
+    tree, catalog and cross-reference table at the end.
+
+    References to the original page objects (e.g. from links) must point to
+    the pages written later on, so the references of all the pages to be
+    added are passed upfront.
+
+    :param stream: a file-like object supporting `write` and `tell`
+    :param page_refs: the original references of the pages, in the order
+                      they will be added
+    """
+
+    def __init__(self, stream, page_refs):
+        self.stream = stream
+        self._offsets = {}
+        self._next_id = 1
+        # (id of the source, idnum, generation) -> new idnum
+        self._ids = {}
+        # keep the sources alive, so their ids are not reused
+        self._sources = {}
+        self._pending = []
+        self._pages_id = self._new_id()
+        self._page_ids = [self._new_id() for __ in page_refs]
+        for ref, idnum in zip(page_refs, self._page_ids):
+            if ref is not None:
+                self._ids[self._get_key(ref)] = idnum
+        self._num_written = 0
+        stream.write(b"%PDF-1.3\n")
+
+    def _new_id(self):
+        idnum = self._next_id
+        self._next_id += 1
+        return idnum
+
+    def _get_key(self, ref):
+        self._sources[id(ref.pdf)] = ref.pdf
+        return id(ref.pdf), ref.idnum, ref.generation
+
+    def _map_reference(self, ref):
+        if ref.pdf is self:
+            return ref
+        key = self._get_key(ref)
+        idnum = self._ids.get(key)
+        if idnum is None:
+            obj = ref.getObject()
+            if isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Pages":
+                # don't copy the page tree of the source
+                idnum = self._pages_id
+            else:
+                idnum = self._new_id()
+                self._pending.append((idnum, obj))
+            self._ids[key] = idnum
+        return IndirectObject(idnum, 0, self)
+
+    def _write_object(self, idnum, obj):
+        if obj is None:
+            obj = NullObject()
+        obj = _copy_object(obj, None, self._map_reference)
+        self._offsets[idnum] = self.stream.tell()
+        self.stream.write(b"%d 0 obj\n" % idnum)
+        obj.writeToStream(self.stream, None)
+        self.stream.write(b"\nendobj\n")
+
+    def add_page(self, page):
+        idnum = self._page_ids[self._num_written]
+        self._num_written += 1
+        page = DictionaryObject(page)
+        page[NameObject("/Parent")] = IndirectObject(self._pages_id, 0, self)
+        contents = page.get("/Contents")
+        if isinstance(contents, StreamObject):
+            # `mergePage` leaves the merged content stream as a direct
+            # object, but streams must be indirect objects
+            contents_id = self._new_id()
+            self._pending.append((contents_id, contents))
+            page[NameObject("/Contents")] = IndirectObject(contents_id, 0, self)
+        self._write_object(idnum, page)
+        while self._pending:
+            self._write_object(*self._pending.pop())
+
+    def finish(self):
+        """Write the page tree, catalog and cross-reference table."""
+        if self._num_written != len(self._page_ids):
+            raise ValueError(
+                "Only {} of {} pages were added".format(
+                    self._num_written, len(self._page_ids)
+                )
+            )
+        pages = DictionaryObject()
+        pages.update(
+            {
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Count"): NumberObject(len(self._page_ids)),
+                NameObject("/Kids"): ArrayObject(
+                    IndirectObject(idnum, 0, self) for idnum in self._page_ids
+                ),
+            }
+        )
+        self._write_object(self._pages_id, pages)
+        info = DictionaryObject()
+        info[NameObject("/Producer")] = createStringObject(
+            codecs.BOM_UTF16_BE + "PyPDF2".encode("utf-16be")
+        )
+        info_id = self._new_id()
+        self._write_object(info_id, info)
+        root = DictionaryObject()
+        root.update(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(self._pages_id, 0, self),
+            }
+        )
+        root_id = self._new_id()
+        self._write_object(root_id, root)
+
+        xref_location = self.stream.tell()
+        self.stream.write(b"xref\n0 %d\n" % self._next_id)
+        self.stream.write(b"%010d %05d f \n" % (0, 65535))
+        for idnum in range(1, self._next_id):
+            self.stream.write(b"%010d %05d n \n" % (self._offsets[idnum], 0))
+        self.stream.write(b"trailer\n")
+        trailer = DictionaryObject()
+        trailer.update(
+            {
+                NameObject("/Size"): NumberObject(self._next_id),
+                NameObject("/Root"): IndirectObject(root_id, 0, self),
+                NameObject("/Info"): IndirectObject(info_id, 0, self),
+            }
+        )
+        trailer.writeToStream(self.stream, None)
+        self.stream.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_location)
+
+
+def write_watermarked(pdf_reader, stream, page_cache=None, engine="merge"):
+    """Watermark the pages of `pdf_reader` and write them one by one."""
+    watermark = get_watermarker(engine, page_cache)
+    pages = [pdf_reader.getPage(i) for i in range(pdf_reader.numPages)]
+    pdf_writer = IncrementalPdfWriter(stream, [page.indirectRef for page in pages])
+    for i, page in enumerate(pages):
+        watermark(page)
+        pdf_writer.add_page(page)
+        # the written page is not needed anymore
+        pages[i] = None
+    pdf_writer.finish()
+
+
+def _watermark_shard(source_path, start, stop, page_cache, engine):
+    # runs in a worker process; the result is passed back as a file since
+    # sending it through the result pipe would keep it in memory twice
+    with open(source_path, "rb") as source:
+        pdf_writer = PdfFileWriter()
+        merge_watermark(
+            PdfFileReader(source), pdf_writer, start, stop, page_cache, engine
+        )
+        with NamedTemporaryFile(suffix=".pdf", delete=False) as output:
+            pdf_writer.write(output)
+    if page_cache is not None:
+        # only send back what is new
+        page_cache.known = None
+    return output.name, page_cache
+
+
+@contextmanager
+def merge_watermark_parallel(
+    executor, source, num_pages, shards, page_cache=None, engine="merge"
+):
+    """Watermark the pages of `source` in worker processes.
+
+    The document is split into `shards` consecutive page ranges which are
+    watermarked in parallel and then reassembled in order.  The pages
+    merged or reused by the workers are added to `page_cache`.
+
+    :return: a context manager yielding a `PdfFileWriter` containing the
+             watermarked pages; it must be written within the context.
+    """
+    shards = max(1, min(shards, num_pages))
+    bounds = [num_pages * i // shards for i in range(shards + 1)]
+    with NamedTemporaryFile(suffix=".pdf") as source_copy:
+        source.seek(0)
+        shutil.copyfileobj(source, source_copy)
+        source_copy.flush()
+        futures = [
+            executor.submit(
+                _watermark_shard, source_copy.name, start, stop, page_cache, engine
+            )
+            for start, stop in zip(bounds, bounds[1:])
+        ]
+        wait(futures)
+
+    with ExitStack() as stack:
+        for future in futures:
+            if not future.exception():
+                stack.callback(os.unlink, future.result()[0])
+        pdf_writer = PdfFileWriter()
+        for future in futures:
+            path, shard_pages = future.result()
+            if page_cache is not None:
+                page_cache.update(shard_pages)
+            shard = stack.enter_context(open(path, "rb"))
+            pdf_reader = PdfFileReader(shard)
+            for i in range(pdf_reader.numPages):
+                pdf_writer.addPage(pdf_reader.getPage(i))
+        yield pdf_writer